@@ -0,0 +1,64 @@
+# Benchmark of `link_UIDs.concatenate_dicoms` against the previous float64 implementation. 
+#
+# Synthetic uint16 single-slice cine niftis are concatenated into a 4D volume with both implementations. The 
+# wall time, peak memory allocated by numpy (tracemalloc) and the size of the saved (uncompressed) nifti are reported. 
+#
+# Usage: python -m benchmarks.bench_concatenate [nx ny n_slices n_phases]
+
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+from data.dicom import link_UIDs
+
+def concatenate_dicoms_float64(file_df):
+    """ Previous implementation of concatenate_dicoms, upcasting every slice to float64. 
+    """
+    nifti_ref = nib.load(file_df.NiftiPath.iloc[0])
+    nx, ny, _, n_frames = nifti_ref.shape
+    n_slices = len(file_df)
+
+    nifti_4D = np.zeros((nx, ny, n_slices, n_frames), dtype=nifti_ref.get_fdata().dtype)
+    for slice_index in range(n_slices):
+        image_slice = nib.load(file_df.NiftiPath.iloc[slice_index]).get_fdata()
+        nifti_4D[:,:,slice_index,:] += image_slice.squeeze()
+
+    return nib.Nifti1Image(nifti_4D, affine=nifti_ref.affine)
+
+def synthetic_slices(savedir, nx, ny, n_slices, n_phases, seed=0):
+    rng = np.random.default_rng(seed)
+    nifti_paths = []
+    for slice_index in range(n_slices):
+        image_slice = rng.integers(0, 4096, size=(nx, ny, 1, n_phases), dtype=np.uint16)
+        nifti_paths += [os.path.join(savedir, 'slice_%02d.nii' % slice_index)]
+        nib.Nifti1Image(image_slice, affine=np.eye(4)).to_filename(nifti_paths[-1])
+    return pd.DataFrame({'NiftiPath': nifti_paths})
+
+def bench_concatenate(concatenate, file_df, savedir):
+    tracemalloc.start()
+    start = time.perf_counter()
+    nifti_4D = concatenate(file_df)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    filename = os.path.join(savedir, 'concatenated.nii')
+    nifti_4D.to_filename(filename)
+    return elapsed, peak, os.path.getsize(filename), nifti_4D.get_data_dtype()
+
+if __name__ == '__main__':
+    shape = tuple(int(n) for n in sys.argv[1:5]) if len(sys.argv) == 5 else (256, 256, 12, 30)
+
+    print('volume', shape)
+    print('%20s %10s %12s %12s %8s' % ('implementation', 'time (s)', 'peak (MB)', 'size (MB)', 'dtype'))
+    with tempfile.TemporaryDirectory() as savedir:
+        file_df = synthetic_slices(savedir, *shape)
+        for name, concatenate in [('float64 (previous)', concatenate_dicoms_float64), 
+                                  ('native dtype',       link_UIDs.concatenate_dicoms)]:
+            elapsed, peak, size, dtype = bench_concatenate(concatenate, file_df, savedir)
+            print('%20s %10.3f %12.1f %12.1f %8s' % (name, elapsed, peak/1e6, size/1e6, dtype))
@@ -0,0 +1,51 @@
+# Benchmark of the header accumulation used by `folder.make_dataset`. 
+#
+# Synthetic dicom headers are created in memory (no disk I/O) and accumulated with `folder._append_header`, 
+# followed by a single DataFrame conversion. The time per header should stay constant from 1k to 100k headers, 
+# i.e., the scan time grows linearly with the number of files. 
+#
+# Usage: python -m benchmarks.bench_header_accumulator
+
+import time
+import pydicom
+import pandas as pd
+
+from data.dicom import folder
+
+def synthetic_dicom():
+    dicom = pydicom.Dataset()
+    dicom.PatientName             = 'Doe^John'
+    dicom.PatientSex              = 'M'
+    dicom.PatientAge              = '040Y'
+    dicom.StudyDate               = '20200102'
+    dicom.SeriesTime              = '101010'
+    dicom.AcquisitionTime         = '101010'
+    dicom.SeriesInstanceUID       = pydicom.uid.generate_uid()
+    dicom.StudyInstanceUID        = pydicom.uid.generate_uid()
+    dicom.SOPInstanceUID          = pydicom.uid.generate_uid()
+    dicom.SeriesDescription       = 'cine sax'
+    dicom.ProtocolName            = 'cine sax'
+    dicom.TriggerTime             = 30.0
+    dicom.InstanceNumber          = 1
+    dicom.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    dicom.ImagePositionPatient    = [-100, -100, 0]
+    dicom.SliceLocation           = 0.0
+    dicom.PixelSpacing            = [1.5, 1.5]
+    dicom.SliceThickness          = 8.0
+    dicom.SpacingBetweenSlices    = 8.0
+    return dicom
+
+def bench_accumulator(n_headers, dicom):
+    start = time.perf_counter()
+    headers = folder._init_header()
+    for n in range(n_headers):
+        folder._append_header(headers, folder.read_header(dicom, 'dicom_%07d.dcm' % n))
+    headers = pd.DataFrame(headers).sort_values(by='FileName')
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    dicom = synthetic_dicom()
+    print('%10s %12s %18s' % ('headers', 'time (s)', 'us per header'))
+    for n_headers in [1000, 10000, 100000]:
+        elapsed = bench_accumulator(n_headers, dicom)
+        print('%10d %12.3f %18.2f' % (n_headers, elapsed, 1e6*elapsed/n_headers))
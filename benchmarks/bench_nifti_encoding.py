@@ -0,0 +1,55 @@
+# Benchmark of the nifti output encodings supported by `convert.save_nifti`. 
+#
+# A synthetic uint16 cine volume (smooth anatomy-like background plus noise) is written with each setting, 
+# and the throughput (uncompressed MB written per second) and file size are reported. 
+#
+# Usage: python -m benchmarks.bench_nifti_encoding [nx ny n_slices n_phases]
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import nibabel as nib
+
+from data.dicom import convert
+
+SETTINGS = [('.nii',    None, None),
+            ('.nii.gz', None, None),
+            ('.nii.gz', 1,    1),
+            ('.nii.gz', 6,    1),
+            ('.nii.gz', 9,    1),
+            ('.nii.gz', 1,    4),
+            ('.nii.gz', 6,    4),
+            ('.nii.gz', 6,    8)]
+
+def synthetic_cine(nx=256, ny=256, n_slices=12, n_phases=30, seed=0):
+    x, y = np.meshgrid(np.linspace(-1, 1, nx), np.linspace(-1, 1, ny), indexing='ij')
+    rng  = np.random.default_rng(seed)
+    cine = np.zeros((nx, ny, n_slices, n_phases), dtype=np.uint16)
+    for t in range(n_phases):
+        radius = 0.3 + 0.05*np.sin(2*np.pi*t/n_phases)
+        for s in range(n_slices):
+            frame = 400*np.exp(-(x**2+y**2)/0.5) + 800*((x**2+y**2) < radius**2)
+            cine[:,:,s,t] = np.clip(frame + rng.normal(0, 20, frame.shape), 0, 4095)
+    return nib.Nifti1Image(cine, affine=np.eye(4))
+
+def bench_encoding(nifti, savedir, nifti_ext, compresslevel, threads):
+    filename = os.path.join(savedir, 'cine' + nifti_ext)
+    start = time.perf_counter()
+    convert.save_nifti(nifti, filename, compresslevel=compresslevel, threads=threads)
+    elapsed = time.perf_counter() - start
+    return elapsed, os.path.getsize(filename)
+
+if __name__ == '__main__':
+    shape = tuple(int(n) for n in sys.argv[1:5]) if len(sys.argv) == 5 else (256, 256, 12, 30)
+    nifti = synthetic_cine(*shape)
+    n_bytes = nifti.dataobj.nbytes
+
+    print('volume', shape, '%.1f MB' % (n_bytes/1e6))
+    print('%8s %14s %8s %10s %10s %8s' % ('ext', 'compresslevel', 'threads', 'MB/s', 'size (MB)', 'ratio'))
+    with tempfile.TemporaryDirectory() as savedir:
+        for nifti_ext, compresslevel, threads in SETTINGS:
+            elapsed, size = bench_encoding(nifti, savedir, nifti_ext, compresslevel, threads)
+            print('%8s %14s %8s %10.1f %10.2f %8.2f' % (nifti_ext, compresslevel, threads, 
+                                                       n_bytes/1e6/elapsed, size/1e6, n_bytes/size))
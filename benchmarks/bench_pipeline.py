@@ -0,0 +1,73 @@
+# Benchmark of the scan, convert and link stages of the pipeline on synthetic cine archives.
+#
+# For each scale, a synthetic archive (see benchmarks/synthetic_dicoms.py) is written to a temporary folder and run
+# through `folder.export_dicom_headers` (scan), `convert._export_niftis` (convert), `link_UIDs.export_linked_niftis`
+# (link from the headers) and `link_UIDs.link_dicoms_with_different_UIDs` (link of converted niftis). The stages
+# are timed with `metrics.RunMetrics` and the throughput is reported in files (dicoms or niftis) and MB read per
+# second (for the scan, only the headers are read). Use --report to also save the metrics report of each scale as JSON.
+#
+# Usage: python -m benchmarks.bench_pipeline [--workers n] [--report prefix] [small medium large ...]
+
+import os
+import argparse
+import tempfile
+import contextlib
+
+from data.dicom import convert, folder, link_UIDs
+from data.dicom.metrics import RunMetrics
+from benchmarks.synthetic_dicoms import write_archive
+
+# (subjects, series, slices, phases, matrix, single_slice_series) of each scale.
+SCALES = {'small':  (2, 1, 6,  10, 64,  6),
+          'medium': (4, 2, 10, 20, 128, 8),
+          'large':  (8, 2, 12, 25, 256, 10)}
+
+# (stage, consecutive metrics stages timing it, counter of files processed) reported for each scale.
+STAGES = [('scan',        ['export_headers'],             'files_parsed'),
+          ('convert',     ['convert_jobs'],               'frames_decoded'),
+          ('link',        ['convert_jobs'],               'frames_decoded'),
+          ('link niftis', ['list_single_slices', 'link'], 'niftis_linked')]
+
+def bench_pipeline(scale, workers=None, report_prefix=None):
+    """ Run the pipeline on a synthetic archive of the given `scale`. Returns the number and size of the dicoms of
+        the archive and the metrics report of each stage, saved to `report_prefix`_<stage>.json if given.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as savedir:
+        dicom_dir = os.path.join(savedir, 'dicoms')
+        n_files, n_bytes = write_archive(dicom_dir, *scale)
+
+        for stage, run in [('scan',        lambda m: folder.export_dicom_headers(dicom_dir, dicom_dir + '_headers',
+                                                                                 workers=workers, metrics=m)),
+                           ('convert',     lambda m: convert._export_niftis(dicom_dir + '_headers', dicom_dir + '_niftis',
+                                                                            ['cine', 'tf2d'], workers=workers, metrics=m)),
+                           ('link',        lambda m: link_UIDs.export_linked_niftis(dicom_dir + '_headers',
+                                                                                    dicom_dir + '_linked', ['tf2d'],
+                                                                                    workers=workers, metrics=m)),
+                           ('link niftis', lambda m: link_UIDs.link_dicoms_with_different_UIDs(dicom_dir + '_niftis',
+                                                                                               metrics=m))]:
+            metrics = RunMetrics(None if report_prefix is None else
+                                 '%s_%s.json' % (report_prefix, stage.replace(' ', '_')))
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                run(metrics)
+            results[stage] = metrics.finish()
+    return n_files, n_bytes, results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('scales', nargs='*', default=['small', 'medium'], choices=list(SCALES))
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--report', default=None, help='prefix of the JSON metrics reports')
+    args = parser.parse_args()
+
+    print('%8s %8s %10s %12s %10s %10s %10s %10s' % ('scale', 'dicoms', 'size (MB)', 'stage', 'time (s)',
+                                                     'files', 'files/s', 'MB/s'))
+    for name in args.scales:
+        report_prefix = None if args.report is None else '%s_%s' % (args.report, name)
+        n_files, n_bytes, results = bench_pipeline(SCALES[name], args.workers, report_prefix)
+        for stage, metrics_stages, counter in STAGES:
+            report  = results[stage]
+            elapsed = sum(report['totals'][metrics_stage]['wall_time'] for metrics_stage in metrics_stages)
+            files   = report['counters'][counter]
+            print('%8s %8d %10.1f %12s %10.3f %10d %10.1f %10.1f' % (name, n_files, n_bytes/1e6, stage, elapsed, files,
+                                                                     files/elapsed, report['counters']['bytes_read']/1e6/elapsed))
@@ -0,0 +1,112 @@
+# Synthetic cine dicom archives used by the pipeline benchmarks.
+#
+# An archive has one folder per subject (the layout expected by `folder.export_dicom_headers`). Each subject has
+# `series` multi-slice cine series ('cine sax') and `single_slice_series` single-slice cine series ('tf2d single'),
+# each with its own SeriesInstanceUID, acquired one after the other at different slice locations so that they are
+# linked into a single stack by `link_UIDs`. Frames are uint16 images of a beating disk with noise.
+#
+# Usage: python -m benchmarks.synthetic_dicoms savedir [subjects series slices phases matrix single_slice_series]
+
+import os
+import sys
+import copy
+import numpy as np
+
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+def write_archive(savedir, subjects=2, series=1, slices=10, phases=20, matrix=128, single_slice_series=6, seed=0):
+    """ Write a synthetic archive to `savedir`. Returns the number of dicoms written and their total size in bytes.
+    """
+    rng    = np.random.default_rng(seed)
+    frames = _beating_disk(matrix, phases, rng)
+
+    n_files, n_bytes = 0, 0
+    for subject in range(subjects):
+        subject_dir = os.path.join(savedir, 'subject_%03d' % subject)
+        os.makedirs(subject_dir, exist_ok=True)
+        template = _template('Doe^Subject%03d' % subject, matrix)
+
+        AcquisitionTime = 80000
+        stacks  = [('cine sax', slices)]*series
+        stacks += [('tf2d single', 1)]*single_slice_series
+        for stack, (SeriesDescription, n_slices) in enumerate(stacks):
+            # single-slice series are acquired at consecutive slice locations, each with its own SeriesInstanceUID.
+            locations = range(n_slices) if n_slices > 1 else [stack - series]
+            SeriesInstanceUID = generate_uid()
+            for SliceIndex, location in enumerate(locations):
+                for InstanceIndex in range(phases):
+                    filename = os.path.join(subject_dir, 'series_%03d_slice_%03d_phase_%03d.dcm' %
+                                                         (stack, SliceIndex, InstanceIndex))
+                    _write_frame(template, filename, frames[InstanceIndex] + 50*location, SeriesInstanceUID,
+                                 SeriesDescription, location, InstanceIndex, SliceIndex*phases+InstanceIndex+1,
+                                 AcquisitionTime)
+                    n_files += 1
+                    n_bytes += os.path.getsize(filename)
+            AcquisitionTime += 100
+    return n_files, n_bytes
+
+def _beating_disk(matrix, phases, rng):
+    x, y = np.meshgrid(np.linspace(-1, 1, matrix), np.linspace(-1, 1, matrix), indexing='ij')
+    frames = []
+    for t in range(phases):
+        radius = 0.3 + 0.05*np.sin(2*np.pi*t/phases)
+        frame  = 400*np.exp(-(x**2+y**2)/0.5) + 800*((x**2+y**2) < radius**2) + rng.normal(0, 20, x.shape)
+        frames += [np.clip(frame, 0, 3000).astype(np.uint16)]
+    return frames
+
+def _template(PatientName, matrix):
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = MRImageStorage
+    file_meta.TransferSyntaxUID       = ExplicitVRLittleEndian
+
+    dicom = FileDataset(None, {}, file_meta=file_meta, preamble=b'\0'*128)
+    dicom.is_little_endian = True
+    dicom.is_implicit_VR   = False
+
+    dicom.SOPClassUID             = MRImageStorage
+    dicom.Modality                = 'MR'
+    dicom.PatientName             = PatientName
+    dicom.PatientSex              = 'M'
+    dicom.PatientAge              = '040Y'
+    dicom.StudyDate               = '20200102'
+    dicom.SeriesTime              = '080000'
+    dicom.StudyInstanceUID        = generate_uid()
+    dicom.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    dicom.PixelSpacing            = [1.5, 1.5]
+    dicom.SliceThickness          = 8.0
+    dicom.SpacingBetweenSlices    = 8.0
+
+    dicom.Rows                      = matrix
+    dicom.Columns                   = matrix
+    dicom.SamplesPerPixel           = 1
+    dicom.PhotometricInterpretation = 'MONOCHROME2'
+    dicom.BitsAllocated             = 16
+    dicom.BitsStored                = 12
+    dicom.HighBit                   = 11
+    dicom.PixelRepresentation       = 0
+    return dicom
+
+def _write_frame(template, filename, frame, SeriesInstanceUID, SeriesDescription, location, InstanceIndex,
+                 InstanceNumber, AcquisitionTime):
+    dicom = copy.deepcopy(template)
+    dicom.SOPInstanceUID = generate_uid()
+    dicom.file_meta.MediaStorageSOPInstanceUID = dicom.SOPInstanceUID
+
+    dicom.SeriesInstanceUID    = SeriesInstanceUID
+    dicom.SeriesDescription    = SeriesDescription
+    dicom.ProtocolName         = SeriesDescription
+    dicom.AcquisitionTime      = '%06d' % AcquisitionTime
+    dicom.TriggerTime          = 30.0*InstanceIndex
+    dicom.InstanceNumber       = InstanceNumber
+    dicom.SliceLocation        = 8.0*location
+    dicom.ImagePositionPatient = [-96.0, -96.0, 8.0*location]
+
+    dicom.PixelData = frame.tobytes()
+    dicom['PixelData'].VR = 'OW'
+    dicom.save_as(filename)
+
+if __name__ == '__main__':
+    options = [int(n) for n in sys.argv[2:]]
+    n_files, n_bytes = write_archive(sys.argv[1], *options)
+    print('Wrote %d dicoms (%.1f MB) to %s' % (n_files, n_bytes/1e6, sys.argv[1]))
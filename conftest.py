@@ -0,0 +1,2 @@
+# Makes the `data` and `benchmarks` packages importable when the tests are run with a plain `pytest` from the 
+# repository root (pytest adds the folder of this file to sys.path).
@@ -0,0 +1,136 @@
+# Manuel A. Morales, PhD (mmorale5@bidmc.harvard.edu)
+# CMR Enthusiast
+
+import threading
+import numpy as np
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .convert import _read_pixel_array
+
+class LazyCine:
+    """ Lazy 4D cine volume of shape (nx, ny, number_of_slices, number_of_phases) backed by its dicoms.
+
+        Indexing (e.g., `vol[:, :, s, t]` or `vol[..., s, :]`) only decodes the frames that are needed. Decoded
+        frames are kept in a least-recently-used cache of at most `cache_size` frames. With `prefetch=n`, the next
+        n phases of the requested slices are decoded in a background thread, which is useful when scrolling
+        through a cine. `np.asarray(vol)` decodes the whole volume, as read by convert.read_cine_protocol.
+
+    Input
+    -----
+    dicom_4D_paths : dictionary mapping each slice index to the list of dicom paths of its phases, as returned by
+                     convert.read_cine_protocol and saved in the `nifti2dicom_paths` folder by _export_niftis.
+
+    cache_size     : maximum number of decoded frames kept in memory.
+
+    prefetch       : number of phases decoded ahead in the background, 0 to disable prefetching.
+    """
+    def __init__(self, dicom_4D_paths, cache_size=256, prefetch=0):
+        self.paths      = np.array([dicom_4D_paths[SliceIndex] for SliceIndex in sorted(dicom_4D_paths)])
+        self.cache_size = cache_size
+        self.prefetch   = prefetch
+
+        self._cache    = OrderedDict()
+        self._lock     = threading.Lock()
+        self._prefetch = ThreadPoolExecutor(max_workers=1) if prefetch else None
+
+        frame       = self.frame(0, 0)
+        self.shape  = frame.shape + self.paths.shape
+        self.dtype  = frame.dtype
+
+    @classmethod
+    def from_npy(cls, path, **kwargs):
+        """ Lazy cine from a `nifti2dicom_paths` .npy file saved by convert._export_niftis.
+        """
+        return cls(np.load(path, allow_pickle=True).item(), **kwargs)
+
+    @classmethod
+    def from_index(cls, dicoms_headers, headers_index, SeriesInstanceUID, **kwargs):
+        """ Lazy cine of a series from a header DataFrame and its HeaderIndex (see hierarchy.HeaderIndex).
+        """
+        series = headers_index.series(SeriesInstanceUID)
+        if series is None: raise ValueError('Series %s is not in the header index!' % SeriesInstanceUID)
+        grid = headers_index.series_grid(series)
+        if grid is None: raise ValueError('Series %s is not a regular (slice, phase) grid!' % SeriesInstanceUID)
+        FileNames = dicoms_headers.FileName.to_numpy()[grid]
+        return cls({SliceIndex: list(FileNames[SliceIndex]) for SliceIndex in range(len(FileNames))}, **kwargs)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def frame(self, SliceIndex, InstanceIndex):
+        """ Returns the decoded frame of a slice and phase, using the cache.
+        """
+        key = (SliceIndex, InstanceIndex)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        frame = _read_pixel_array(self.paths[key])
+
+        with self._lock:
+            self._cache[key] = frame
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return frame
+
+    def __getitem__(self, key):
+        key = _expand_key(key, self.ndim)
+
+        # only the slices and phases selected by the last two indices are decoded. Their indices are then mapped to
+        # the decoded block keeping their kind (integer, slice or array), so that numpy's indexing rules (e.g., for
+        # mixed advanced indices) give the same result as on the decoded volume.
+        slice_indices, slice_key = _block_index(key[2], self.shape[2])
+        phase_indices, phase_key = _block_index(key[3], self.shape[3])
+
+        block = np.empty(self.shape[:2] + (len(slice_indices), len(phase_indices)), dtype=self.dtype)
+        for i, SliceIndex in enumerate(slice_indices):
+            for j, InstanceIndex in enumerate(phase_indices):
+                block[:,:,i,j] = self.frame(SliceIndex, InstanceIndex)
+
+        if self._prefetch is not None and block.size:
+            self._prefetch.submit(self._prefetch_phases, slice_indices, phase_indices)
+
+        return block[(key[0], key[1], slice_key, phase_key)]
+
+    def _prefetch_phases(self, slice_indices, phase_indices):
+        """ Decode the `prefetch` phases following `phase_indices` (cyclically) for each slice in `slice_indices`.
+        """
+        for SliceIndex in slice_indices:
+            for step in range(1, self.prefetch+1):
+                self.frame(SliceIndex, (phase_indices[-1] + step) % self.shape[3])
+
+    def __array__(self, dtype=None, copy=None):
+        volume = self[:, :, :, :]
+        return volume if dtype is None else volume.astype(dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def close(self):
+        """ Stop the background prefetching thread.
+        """
+        if self._prefetch is not None: self._prefetch.shutdown(wait=True, cancel_futures=True)
+
+def _block_index(index, n):
+    """ Returns the positions selected by `index` along an axis of length `n`, in the order they are decoded, and
+        `index` mapped to these positions.
+    """
+    selected = np.arange(n)[index]
+    if isinstance(index, slice): return selected, slice(None)
+    positions = np.unique(selected)
+    return positions, np.searchsorted(positions, selected)
+
+def _expand_key(key, ndim):
+    """ Expand an indexing `key` (which may contain an Ellipsis or fewer than `ndim` indices) into `ndim` indices.
+    """
+    key = key if isinstance(key, tuple) else (key,)
+    if any(index is Ellipsis for index in key):
+        position = [index is Ellipsis for index in key].index(True)
+        key = key[:position] + (slice(None),)*(ndim - len(key) + 1) + key[position+1:]
+    if len(key) > ndim: raise IndexError('too many indices for a %dD cine' % ndim)
+    return key + (slice(None),)*(ndim - len(key))
@@ -2,7 +2,10 @@
 # CMR Enthusiast
 
 import os
-import glob
+import gzip
+import json
+import time
+import hashlib
 import pydicom
 import warnings
 import numpy as np
@@ -10,24 +13,355 @@ import pandas as pd
 import nibabel as nib
 
 from . import folder 
+from .metrics import get_metrics
+from .work_queue import get_work_queue
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 def _export_niftis(headers_dir, 
                    savedir,
                    SeriesDescriptionContainsTrues=[], 
                    SeriesDescriptionContainsFalse=[],
-                   select_subject=None):
+                   select_subject=None,
+                   frame_workers=None,
+                   workers=None,
+                   max_voxels=None,
+                   overwrite=False,
+                   nifti_ext='.nii.gz',
+                   compresslevel=None,
+                   gzip_threads=None,
+                   streaming=False,
+                   slice_order='SliceLocation',
+                   metrics=None,
+                   work_queue=None):
+    """ Convert the cine series listed in the header files of `headers_dir` to niftis in `savedir`. 
+
+        The (subject, series, SeriesInstanceUID) conversions are first listed with conversion_jobs and then run 
+        serially or, with `workers=n`, across a pool of n processes. `max_voxels` bounds the peak memory of the pool: 
+        a job is only started if the estimated voxel count of the running jobs stays below `max_voxels` (a single job 
+        is always allowed to run). Failed conversions do not stop the run; they are reported at the end.
+
+        A manifest `savedir/conversion_manifest.json` records a fingerprint of the header rows and dicom files 
+        (size and modification time) of each converted series and of the `slice_order` used. Unless `overwrite=True`, series whose fingerprint 
+        did not change and whose outputs exist are skipped, so that an interrupted run can be resumed. Outputs are 
+        written to temporary files and renamed, so a crash never leaves partially written files behind. 
+
+        Niftis are written with extension `nifti_ext` ('.nii.gz' or '.nii' for uncompressed files) using 
+        save_nifti with the given `compresslevel` and `gzip_threads`. With `streaming=True`, each 4D volume is 
+        assembled frame by frame into a memory-mapped uncompressed nifti on disk (see read_cine_protocol) instead 
+        of in memory, which bounds the memory of each job to about one frame. Slices are ordered by SliceLocation 
+        or, with slice_order='position', by their position along the slice normal (see read_cine_protocol). 
+
+        If a metrics.RunMetrics instance is given as `metrics`, the wall and CPU time, bytes read, frames decoded 
+        and bytes written of each series are recorded, as well as the rejected series (see run_conversion_jobs). 
+
+        To split the subjects across several processes or hosts sharing the file system, run _export_niftis in each 
+        of them with the same `work_queue` (a work_queue.WorkQueue or the path of its folder, not shared with 
+        folder.export_dicom_headers). Each subject is then claimed and converted by a single worker, and the 
+        manifest is updated under a lock of the queue. 
 
-    dicoms_header_subjects = glob.glob(os.path.join(headers_dir, '*'))              
+    Return
+    ------
+    failures : dictionary mapping the nifti path of each failed job to the reason of failure. 
+    """
+    options = dict(frame_workers=frame_workers, workers=workers, max_voxels=max_voxels, overwrite=overwrite, 
+                   compresslevel=compresslevel, gzip_threads=gzip_threads, streaming=streaming, 
+                   slice_order=slice_order, metrics=metrics)
+    if work_queue is None:
+        jobs = conversion_jobs(headers_dir, savedir, SeriesDescriptionContainsTrues, SeriesDescriptionContainsFalse, 
+                               select_subject, nifti_ext)
+        return run_conversion_jobs(jobs, savedir, **options)
+
+    work_queue = get_work_queue(work_queue)
+    PatientIDs = sorted(folder.header_patient_id(path) for path in folder.list_header_files(headers_dir))
+    failures   = {}
+    for PatientID in work_queue.claimed([PatientID for PatientID in PatientIDs 
+                                         if select_subject is None or PatientID in select_subject]):
+        jobs = conversion_jobs(headers_dir, savedir, SeriesDescriptionContainsTrues, SeriesDescriptionContainsFalse, 
+                               [PatientID], nifti_ext)
+        failures.update(run_conversion_jobs(jobs, savedir, work_queue=work_queue, **options))
+    return failures
+
+def run_conversion_jobs(jobs, 
+                        savedir, 
+                        frame_workers=None,
+                        workers=None,
+                        max_voxels=None,
+                        overwrite=False,
+                        compresslevel=None,
+                        gzip_threads=None,
+                        streaming=False,
+                        slice_order='SliceLocation',
+                        metrics=None,
+                        work_queue=None):
+    """ Run conversion `jobs` (see conversion_jobs) with the manifest kept in `savedir`. See _export_niftis for 
+        a description of the options. Returns a dictionary mapping the nifti path of failed jobs to the reason of failure. 
+
+        With `metrics` (see metrics.RunMetrics), a `convert` stage is recorded for each series, timed in the process 
+        converting it. Failed series are counted as `variable_phases` or `failed` rejections. 
+
+        If a `work_queue` (see work_queue.WorkQueue) is given, the manifest may be shared with other workers and is 
+        re-read and updated under a lock of the queue whenever it is saved. 
+
+        The manifest is saved every MANIFEST_SAVE_JOBS finished jobs or MANIFEST_SAVE_INTERVAL seconds and when the 
+        run ends (or is interrupted), rather than after each job. If the process is killed, the jobs finished since 
+        the last save are converted again by the next run. 
+    """
+    metrics = get_metrics(metrics)
+    with metrics.stage('convert_jobs', savedir=savedir):
+        return _run_conversion_jobs(jobs, savedir, frame_workers, workers, max_voxels, overwrite, compresslevel, 
+                                    gzip_threads, streaming, slice_order, metrics, work_queue)
+
+# finished jobs and seconds between two saves of the conversion manifest, see run_conversion_jobs.
+MANIFEST_SAVE_JOBS     = 100
+MANIFEST_SAVE_INTERVAL = 30
+
+def _run_conversion_jobs(jobs, savedir, frame_workers, workers, max_voxels, overwrite, compresslevel, gzip_threads, 
+                         streaming, slice_order, metrics, work_queue):
+    manifest_path = os.path.join(savedir, 'conversion_manifest.json')
+    manifest = load_manifest(manifest_path)
+
+    n_jobs = len(jobs)
+    for job in jobs: job['fingerprint'] = series_fingerprint(job['header'], slice_order)
+    if not overwrite:
+        jobs = [job for job in jobs if not _is_current(job, manifest)]
+        print('Skipping %d series with unchanged inputs' % (n_jobs-len(jobs)))
+        metrics.count('series_skipped', n_jobs-len(jobs))
+
+    failures = {}
+    updates  = {} # manifest entries (nifti path -> fingerprint, or None if failed) not saved yet.
+    saved    = time.monotonic()
+    def _save():
+        nonlocal manifest, saved
+        if not updates: return
+        with nullcontext() if work_queue is None else work_queue.locked('conversion_manifest'):
+            if work_queue is not None: manifest = load_manifest(manifest_path)
+            for save_nii, fingerprint in updates.items():
+                if fingerprint is None: manifest.pop(save_nii, None)
+                else: manifest[save_nii] = fingerprint
+            save_manifest(manifest_path, manifest)
+        updates.clear()
+        saved = time.monotonic()
+
+    def _finish(job, result):
+        failure, wall_time, cpu_time = result
+        _record_job(job, failure, wall_time, cpu_time, metrics)
+        updates[job['save_nii']] = job['fingerprint'] if failure is None else None
+        if failure is not None: failures[job['save_nii']] = failure
+        if len(updates) >= MANIFEST_SAVE_JOBS or time.monotonic() - saved >= MANIFEST_SAVE_INTERVAL: _save()
+
+    try:
+        if workers is None:
+            for job in jobs:
+                _finish(job, _timed_convert_series(job, frame_workers, compresslevel, gzip_threads, streaming, 
+                                                   slice_order))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                running = {}
+                pending = list(jobs)
+                while pending or running:
+                    while pending and len(running) < workers and (not running or max_voxels is None or 
+                          sum(job['voxels'] for job in running.values()) + pending[0]['voxels'] <= max_voxels):
+                        job = pending.pop(0)
+                        running[pool.submit(_timed_convert_series, job, frame_workers, compresslevel, gzip_threads, 
+                                            streaming, slice_order)] = job
+
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        job = running.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as error:
+                            # e.g., a worker process that died; the other jobs are still run and reported. 
+                            result = ('%s: %s' % (type(error).__name__, error), 0., 0.)
+                        _finish(job, result)
+    finally:
+        _save()
+
+    print('Converted %d of %d series' % (len(jobs)-len(failures), len(jobs)))
+    for save_nii, failure in failures.items():
+        print('Failed:', save_nii, failure)
+
+    return failures
+
+def _timed_convert_series(job, *args):
+    """ Run convert_series and return its result with the wall and CPU time (of all threads) of the conversion. 
+    """
+    wall_time, cpu_time = time.perf_counter(), time.process_time()
+    failure = convert_series(job, *args)
+    return failure, time.perf_counter()-wall_time, time.process_time()-cpu_time
+
+def _record_job(job, failure, wall_time, cpu_time, metrics):
+    """ Record the `convert` stage of a finished conversion `job` in `metrics`. 
+    """
+    if not metrics.enabled: return
+    fields = {'subject':   os.path.basename(os.path.dirname(os.path.dirname(job['save_nii']))),
+              'series':    os.path.basename(job['save_nii']),
+              'dicoms':    len(job['header']),
+              'bytes_read': sum(os.path.getsize(filename) for filename in job['header'].FileName 
+                                if os.path.isfile(filename))}
+    if failure is None:
+        fields['frames_decoded'] = len(job['header'])
+        fields['bytes_written']  = sum(os.path.getsize(output) for output in 
+                                       [job['save_nii'], job['save_npy'], job['save_npy_dic']])
+        metrics.count('series_converted')
+    else:
+        fields['failure'] = failure
+        metrics.reject('variable_phases' if failure == VARIABLE_PHASES else 'failed')
+
+    for key in ['bytes_read', 'frames_decoded', 'bytes_written']:
+        if key in fields: metrics.count(key, fields[key])
+    metrics.record('convert', wall_time, cpu_time, fields)
+
+def series_fingerprint(series_dicom_header, slice_order='SliceLocation'):
+    """ Returns a hash of the header rows of a series, of the size and modification time of its dicoms, and of the 
+        `slice_order` of its nifti (see read_cine_protocol). 
+    """
+    series_dicom_header = series_dicom_header.sort_values(by='FileName')
+    fingerprint = hashlib.sha1(series_dicom_header.to_csv(index=False).encode('utf-8'))
+    fingerprint.update(('slice_order %s' % slice_order).encode('utf-8'))
+    for filename in series_dicom_header.FileName:
+        try:
+            stat = os.stat(filename)
+            fingerprint.update(('%s %d %d' % (filename, stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+        except OSError:
+            fingerprint.update(('%s missing' % filename).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+def load_manifest(manifest_path):
+    """ Load the conversion manifest (nifti path -> fingerprint) written by _export_niftis. 
+    """
+    if not os.path.isfile(manifest_path): return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def save_manifest(manifest_path, manifest):
+    """ Save the conversion `manifest` (see load_manifest) to `manifest_path`. The file is replaced atomically. 
+    """
+    with open(_temporary_path(manifest_path), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(_temporary_path(manifest_path), manifest_path)
+
+def _is_current(job, manifest):
+    outputs = [job['save_nii'], job['save_npy'], job['save_npy_dic']]
+    return manifest.get(job['save_nii']) == job['fingerprint'] and all(os.path.isfile(output) for output in outputs)
+
+def _temporary_path(path):
+    """ Temporary path in the same folder as `path` (so that os.replace is atomic) keeping its extension. 
+    """
+    return os.path.join(os.path.dirname(path), '.tmp_%d_' % os.getpid() + os.path.basename(path))
+
+def _strip_nifti_ext(path):
+    """ Returns `path` without its '.nii' or '.nii.gz' extension. 
+    """
+    for ext in ('.nii.gz', '.nii'):
+        if path.endswith(ext): return path[:-len(ext)]
+    return path
+
+def _save_npy(path, array):
+    with open(_temporary_path(path), 'wb') as f:
+        np.save(f, array)
+    os.replace(_temporary_path(path), path)
+
+def _save_nifti(path, nifti, compresslevel=None, gzip_threads=None):
+    save_nifti(nifti, _temporary_path(path), compresslevel=compresslevel, threads=gzip_threads)
+    os.replace(_temporary_path(path), path)
+
+# size of the blocks compressed independently by save_nifti when using multiple threads. 
+GZIP_BLOCK_SIZE = 1024*1024
+
+def save_nifti(nifti, filename, compresslevel=None, threads=None):
+    """ Save a `nifti` image to `filename`. Files ending with '.gz' are compressed, otherwise they are uncompressed. 
 
+    Input
+    -----
+    compresslevel : int between 1 (fastest) and 9 (smallest). If None, nibabel's default level is used.
+
+    threads : int, number of threads used to compress the file. The image is split in blocks of GZIP_BLOCK_SIZE 
+              bytes which are compressed in parallel and written as consecutive gzip members. The output is a 
+              standard (multi-member) gzip stream that can be read by any nifti reader. 
+    """
+    if not filename.endswith('.gz') or (compresslevel is None and threads is None):
+        nifti.to_filename(filename)
+        return
+
+    content = nifti.to_bytes()
+    blocks  = (content[start:start+GZIP_BLOCK_SIZE] for start in range(0, len(content), GZIP_BLOCK_SIZE))
+    with open(filename, 'wb') as f:
+        _write_gzip_blocks(blocks, f, compresslevel, threads)
+
+def save_streamed_nifti(nii_file, filename, compresslevel=None, threads=None):
+    """ Move an uncompressed nifti file `nii_file` (e.g., written by nifti_memmap) to `filename`. If `filename` 
+        ends with '.gz', the file is compressed block by block (see save_nifti) without loading it in memory. 
+    """
+    if not filename.endswith('.gz'):
+        os.replace(nii_file, filename)
+        return
+
+    with open(nii_file, 'rb') as src, open(filename, 'wb') as f:
+        _write_gzip_blocks(iter(lambda: src.read(GZIP_BLOCK_SIZE), b''), f, compresslevel, threads)
+    os.remove(nii_file)
+
+def _write_gzip_blocks(blocks, f, compresslevel=None, threads=None):
+    """ Compress each block of the iterable `blocks` as a gzip member and write it to the file object `f`. 
+        Blocks are compressed by `threads` threads, in batches so that only a few blocks are held in memory. 
+    """
+    if compresslevel is None: compresslevel = nib.openers.Opener.default_compresslevel
+    threads = threads or 1
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while True:
+            batch = [block for _, block in zip(range(2*threads), blocks)]
+            if not batch: break
+            for member in pool.map(lambda block: gzip.compress(block, compresslevel=compresslevel), batch):
+                f.write(member)
+
+def nifti_memmap(filename, shape, dtype, affine, slope_inter=None):
+    """ Create an uncompressed nifti file `filename` with the given data `shape`, `dtype` and `affine`, and return 
+        its voxel data as a writable numpy memmap. The file is valid once the memmap is flushed. If given, the 
+        (slope, intercept) `slope_inter` is stored in the header and applied to the raw data when the file is read. 
+    """
+    # a zero-strided array of the right shape and dtype is enough to build the header without allocating memory. 
+    nifti  = nib.Nifti1Image(np.broadcast_to(np.zeros((), dtype=dtype), shape), affine=affine)
+    header = nifti.header
+    header.set_data_offset(352)
+    if slope_inter is not None: header.set_slope_inter(*slope_inter)
+    offset = header.get_data_offset()
+    dtype  = header.get_data_dtype()
+    with open(filename, 'wb') as f:
+        header.write_to(f)
+        f.write(b'\x00'*(offset-f.tell()))
+        f.truncate(offset + int(np.prod(shape))*dtype.itemsize)
+    return np.memmap(filename, dtype=dtype, mode='r+', offset=offset, shape=shape, order='F')
+
+def conversion_jobs(headers_dir, 
+                    savedir,
+                    SeriesDescriptionContainsTrues=[], 
+                    SeriesDescriptionContainsFalse=[],
+                    select_subject=None,
+                    nifti_ext='.nii.gz'):
+    """ List the conversions performed by _export_niftis, one for each (subject, series, SeriesInstanceUID). 
+        Series are looked up in the HeaderIndex of each header file (see folder.read_header_hierarchy). 
+
+    Return
+    ------
+    jobs : list of dictionaries with the `header` DataFrame of the series, the output paths (`save_nii`, `save_npy` 
+           and `save_npy_dic`), the estimated number of `voxels` of the series, and the (slice, phase) `grid` of 
+           dicom file names of the series (None if it has to be rebuilt with cine_index). 
+    """
+    dicoms_header_subjects = folder.list_header_files(headers_dir)
+
+    jobs = {}
     for dicoms_header_subject in dicoms_header_subjects:
         
         # PatientID should have format YYYY_MM_DD_PatientName or YYYY_MM_DD_FNLNS
-        PatientID = os.path.basename(dicoms_header_subject).strip('_dicoms_headers.csv')
+        PatientID = folder.header_patient_id(dicoms_header_subject)
 
         if select_subject is not None:
             if PatientID not in select_subject: continue
         
-        subject_dicoms_header_complete = pd.read_csv(dicoms_header_subject, index_col=0)
+        subject_dicoms_header_complete = folder.read_dicom_headers(dicoms_header_subject)
+        headers_index = folder.read_header_hierarchy(dicoms_header_subject, subject_dicoms_header_complete)
+        FileNames     = subject_dicoms_header_complete.FileName.to_numpy()
         
         print('='*50)
         print(subject_dicoms_header_complete.PatientName.unique())
@@ -35,7 +369,7 @@ def _export_niftis(headers_dir,
 
         # it is better to treat each desired Series description separately 
         for SeriesDescriptionContainsTrue in SeriesDescriptionContainsTrues:
-            subject_dicoms_header = subject_dicoms_header_complete.copy()
+            subject_dicoms_header = subject_dicoms_header_complete
 
             
             # only include dicoms matching the `SeriesDescriptionContainsTrue` string. From those, exclude the ones
@@ -47,55 +381,115 @@ def _export_niftis(headers_dir,
                 SeriesDescription = subject_dicoms_header.SeriesDescription.unique()[0]
                 Targets = (subject_dicoms_header.SeriesDescription==SeriesDescription).to_numpy()
             else:
-                Targets = subject_dicoms_header.SeriesDescription.str.contains(SeriesDescriptionContainsTrue, regex=True).to_numpy()
+                Targets = subject_dicoms_header.SeriesDescription.str.contains(SeriesDescriptionContainsTrue, regex=True, na=False).to_numpy()
             
             if SeriesDescriptionContainsFalse:
-                Exclude = ~subject_dicoms_header.SeriesDescription.str.contains('|'.join(SeriesDescriptionContainsFalse)).to_numpy()
+                Exclude = ~subject_dicoms_header.SeriesDescription.str.contains('|'.join(SeriesDescriptionContainsFalse), na=False).to_numpy()
                 
-                subject_dicoms_header = subject_dicoms_header.iloc[Targets&Exclude,:]
+                Selected = Targets&Exclude
             else:
-                subject_dicoms_header = subject_dicoms_header.iloc[Targets,:]
+                Selected = Targets
 
             os.makedirs(os.path.join(savedir, PatientID, 'niftis'), exist_ok=True)
             os.makedirs(os.path.join(savedir, PatientID, 'slice_locations'), exist_ok=True)
             os.makedirs(os.path.join(savedir, PatientID, 'nifti2dicom_paths'), exist_ok=True)
-            for SeriesDescription in subject_dicoms_header.SeriesDescription.unique():
-                index = '_'.join(SeriesDescription.split(' '))
-                index = index.replace('/', '_')
-                save_name = PatientID + '_' + index
-                
-                series_dicoms_header = subject_dicoms_header[subject_dicoms_header.SeriesDescription==SeriesDescription]
+            for series in range(headers_index.n_groups('SeriesInstanceUID')):
+                series_rows = headers_index.group_rows('SeriesInstanceUID', series)
+                rows        = np.sort(series_rows[Selected[series_rows]])
+                if len(rows) == 0: continue
 
-                for SeriesInstanceUID in sorted(series_dicoms_header['SeriesInstanceUID'].unique()):
+                series_dicoms_header = subject_dicoms_header.iloc[rows]
+                SeriesDescriptions   = series_dicoms_header.SeriesDescription.unique()
 
-                    instance_dicoms_header = series_dicoms_header[series_dicoms_header.SeriesInstanceUID==SeriesInstanceUID]   
+                # the grid of the index can only be used if the whole series is converted as a single job. 
+                grid = headers_index.series_grid(series) if (len(rows)==len(series_rows))&(len(SeriesDescriptions)==1) else None
 
-                    print('instance shape', instance_dicoms_header.shape)
+                for SeriesDescription in SeriesDescriptions:
+                    index = '_'.join(SeriesDescription.split(' '))
+                    index = index.replace('/', '_')
+                    save_name = PatientID + '_' + index
+
+                    instance_dicoms_header = series_dicoms_header[series_dicoms_header.SeriesDescription==SeriesDescription]   
                     AcquisitionTime = min(instance_dicoms_header.AcquisitionTime)
 
-                    save_npy_dic = os.path.join(savedir, PatientID, 'nifti2dicom_paths', save_name+'_dicom_paths_AcqTime_%d.npy'%(AcquisitionTime))
-                    save_npy = os.path.join(savedir, PatientID, 'slice_locations', save_name+'_slice_locations_AcqTime_%d.npy'%(AcquisitionTime))
-                    save_nii = os.path.join(savedir, PatientID, 'niftis', save_name+'_AcqTime_%d.nii.gz'%(AcquisitionTime))
-                    
-                    #print('Saving slices locations to:', save_npy)
-                    print('Saving nifti to:', save_nii)
-
-                    # read and save locations (in mm) of image slices in nifti. This is useful to align with other datasets. 
-                    SliceLocations = instance_dicoms_header[instance_dicoms_header.SeriesInstanceUID==SeriesInstanceUID].SliceLocation.unique()     
-                    np.save(save_npy, SliceLocations)
-                    
-                    # convert dicoms to nifti and save. 
-                    sax_nifti, dicom_4D_paths = read_cine_protocol(series_dicom_header=instance_dicoms_header)
-                    # TODO: handle QA errors when creating nifti
-                    if sax_nifti is None: continue
-                    sax_nifti.to_filename(save_nii)
-                    np.save(save_npy_dic, dicom_4D_paths)
-
-                    print('nifti shape:', sax_nifti.shape)
-                    print('slices shape:', SliceLocations.shape)
-
-
-def read_cine_protocol(series_dicom_header):
+                    save_nii = os.path.join(savedir, PatientID, 'niftis', save_name+'_AcqTime_%d'%(AcquisitionTime)+nifti_ext)
+                    # a series matching several `SeriesDescriptionContainsTrues` is only converted once. 
+                    if save_nii in jobs: continue
+
+                    jobs[save_nii] = {'header':       instance_dicoms_header,
+                                      'save_nii':     save_nii,
+                                      'save_npy':     os.path.join(savedir, PatientID, 'slice_locations', save_name+'_slice_locations_AcqTime_%d.npy'%(AcquisitionTime)),
+                                      'save_npy_dic': os.path.join(savedir, PatientID, 'nifti2dicom_paths', save_name+'_dicom_paths_AcqTime_%d.npy'%(AcquisitionTime)),
+                                      'voxels':       _estimate_voxels(instance_dicoms_header),
+                                      'grid':         None if grid is None else FileNames[grid]}
+
+    return list(jobs.values())
+
+def _estimate_voxels(series_dicom_header):
+    """ Estimate the number of voxels of a series from its number of dicoms and matrix size. Header files 
+        exported without Rows/Columns assume a 256x256 matrix. 
+    """
+    if 'Rows' in series_dicom_header and 'Columns' in series_dicom_header:
+        matrix_size = (series_dicom_header.Rows.astype(float)*series_dicom_header.Columns.astype(float)).max()
+        if not np.isnan(matrix_size): return int(len(series_dicom_header)*matrix_size)
+    return len(series_dicom_header)*256*256
+
+# reason of failure of series whose number of phases is variable across slice locations. 
+VARIABLE_PHASES = 'Number of phases is variable across slice locations'
+
+def convert_series(job, frame_workers=None, compresslevel=None, gzip_threads=None, streaming=False, 
+                   slice_order='SliceLocation'):
+    """ Run a single conversion job listed by conversion_jobs. Returns None on success, otherwise the reason of failure. 
+        Errors raised while reading or writing are returned as the reason of failure and the temporary files of the 
+        job are removed. The nifti is saved with the given `compresslevel` and `gzip_threads` (see save_nifti). With `streaming=True` 
+        the volume is assembled in a memory-mapped file next to the output instead of in memory. 
+        Slices are ordered according to `slice_order` (see read_cine_protocol). 
+    """
+    instance_dicoms_header = job['header']
+    print('instance shape', instance_dicoms_header.shape)
+    
+    #print('Saving slices locations to:', save_npy)
+    print('Saving nifti to:', job['save_nii'])
+
+    out_file = _temporary_path(_strip_nifti_ext(job['save_nii']) + '_stream.nii') if streaming else None
+    try:
+        # convert dicoms to nifti and save. 
+        sax_nifti, dicom_4D_paths = read_cine_protocol(series_dicom_header=instance_dicoms_header, 
+                                                       workers=frame_workers, out_file=out_file, 
+                                                       slice_order=slice_order, dicom_4D_grid=job.get('grid'))
+        if sax_nifti is None: return VARIABLE_PHASES
+
+        # save locations (in mm) of image slices in nifti order. This is useful to align with other datasets. 
+        SliceLocations = grid_slice_locations(instance_dicoms_header, dicom_4D_paths, slice_order)
+        _save_npy(job['save_npy'], SliceLocations)
+
+        if streaming:
+            save_streamed_nifti(out_file, _temporary_path(job['save_nii']), compresslevel, gzip_threads)
+            os.replace(_temporary_path(job['save_nii']), job['save_nii'])
+        else:
+            _save_nifti(job['save_nii'], sax_nifti, compresslevel, gzip_threads)
+        _save_npy(job['save_npy_dic'], dicom_4D_paths)
+    except Exception as error:
+        temporary_files = [out_file] + [_temporary_path(job[key]) for key in ['save_nii', 'save_npy', 'save_npy_dic']]
+        for temporary_file in temporary_files:
+            if temporary_file is not None and os.path.isfile(temporary_file): os.remove(temporary_file)
+        return '%s: %s' % (type(error).__name__, error)
+
+    print('nifti shape:', sax_nifti.shape)
+    print('slices shape:', SliceLocations.shape)
+
+def grid_slice_locations(series_dicom_header, dicom_4D_paths, slice_order='SliceLocation'):
+    """ Returns the location of each slice of `dicom_4D_paths` (see read_cine_protocol), in slice order: the 
+        SliceLocation or, with slice_order='position', the position along the slice normal (see cine_index). 
+    """
+    first_frames = [dicom_4D_paths[SliceIndex][0] for SliceIndex in sorted(dicom_4D_paths)]
+    slices_header = series_dicom_header.set_index('FileName', drop=False).loc[first_frames]
+    if slice_order == 'position':
+        return np.round(series_geometry(slices_header)[2], 3)
+    return slices_header.SliceLocation.to_numpy()
+
+def read_cine_protocol(series_dicom_header, workers=None, executor='thread', out_file=None, slice_order='SliceLocation', 
+                       dicom_4D_grid=None):
     """" Read a cine protocol and convert to 4D NIFTI format. This function can fail if basic assumptions about 
          the cine acquisition are violated. 
 
@@ -104,6 +498,21 @@ def read_cine_protocol(series_dicom_header):
     series_dicom_header: a pandas DataFrame containing the necessary dicom header information to construct 
                         the 4D array. 
 
+    workers : int, maximum number of frames decoded concurrently (see read_frames). If None, frames are read serially.
+
+    executor : 'thread', 'process' or a concurrent.futures.Executor instance used when `workers` is set. 
+
+    out_file : path of an uncompressed nifti ('.nii') file. If given, the 4D array is memory-mapped to this file 
+               and filled frame by frame instead of being held in memory, and the returned nifti is loaded lazily 
+               from the file. 
+
+    slice_order : 'SliceLocation' or 'position' to order the slices by their position along the slice normal 
+                  (see cine_index). The affine is taken from the first slice in this order. 
+
+    dicom_4D_grid : optional (slice, phase) grid of dicom file names already known from a HeaderIndex (see 
+                    HeaderIndex.series_grid). It is only used with slice_order='SliceLocation'; otherwise, or if 
+                    None, the grid is built with cine_index. 
+
     Return
     ------
     sax_4D : concatenated dicom images into a 4D nifti array containing affine information. 
@@ -115,65 +524,162 @@ def read_cine_protocol(series_dicom_header):
     assert len(series_dicom_header.SpacingBetweenSlices.unique()) == 1
 
     SpacingBetweenSlices = list(series_dicom_header.SpacingBetweenSlices)[0]
-    SliceLocations = series_dicom_header.SliceLocation.unique()
-    number_of_slices = len(SliceLocations) 
 
-    phases_per_slice = [len(series_dicom_header[series_dicom_header.SliceLocation==SliceLocation].InstanceNumber) 
-                        for SliceLocation in series_dicom_header.SliceLocation.unique()]
-    number_of_phases = phases_per_slice[0]
+    # the geometry of all dicoms is computed once for the series. 
+    affines, _, positions = series_geometry(series_dicom_header)
 
-    if len(np.unique(phases_per_slice)) != 1:
+    if dicom_4D_grid is None or slice_order != 'SliceLocation':
+        _, dicom_4D_grid = cine_index(series_dicom_header, slice_order=slice_order, positions=positions)
+    if dicom_4D_grid is None:
         warnings.warn('Number of phases is variable across slice locations! Could be real or error, check!.')
-        return None
+        return None, None
+    number_of_slices, number_of_phases = dicom_4D_grid.shape
    
     print('Found cine study with (number_of_slices, number_of_phases)', number_of_slices, number_of_phases)
     pixel_array = pydicom.read_file(series_dicom_header.iloc[0].FileName).pixel_array
+
+    if slice_order == 'position':
+        affine = affines[np.argmin(positions)]
+    else:
+        affine = affines[series_dicom_header.SliceLocation.argmin()]
+    if np.isnan(affine).any():
+        raise ValueError('Missing geometry (ImagePositionPatient, ImageOrientationPatient, PixelSpacing or '
+                         'SliceThickness) in the first slice of the series!')
+    shape  = pixel_array.shape +(number_of_slices, number_of_phases)
    
-    sax_4D = np.zeros((pixel_array.shape +(number_of_slices, number_of_phases)), dtype=pixel_array.dtype)
+    if out_file is None:
+        sax_4D = np.zeros(shape, dtype=pixel_array.dtype)
+        read_frames(dicom_4D_grid, sax_4D, workers=workers, executor=executor)
+        sax_4D = nib.Nifti1Image(sax_4D, affine=affine)
+    else:
+        sax_4D = nifti_memmap(out_file, shape, pixel_array.dtype, affine)
+        read_frames(dicom_4D_grid, sax_4D, workers=workers, executor=executor)
+        sax_4D.flush()
+        del sax_4D
+        sax_4D = nib.load(out_file)
+    sax_4D.SpacingBetweenSlices = SpacingBetweenSlices
     
-    dicom_4D_paths = {}
-    for SliceIndex, SliceLocation in enumerate(sorted(SliceLocations)):
-        slice_header = series_dicom_header[series_dicom_header.SliceLocation==SliceLocation]
-        dicom_4D_paths[SliceIndex] = []
-        for InstanceIndex, InstanceNumber in enumerate(sorted(slice_header.InstanceNumber)):
-            DicomFileName = slice_header[slice_header.InstanceNumber==InstanceNumber].FileName.item()
-            dicom = pydicom.read_file(DicomFileName)
-            sax_4D[:,:,SliceIndex,InstanceIndex] += dicom.pixel_array
+    dicom_4D_paths = {SliceIndex: list(dicom_4D_grid[SliceIndex]) for SliceIndex in range(number_of_slices)}
 
-            dicom_4D_paths[SliceIndex] += [DicomFileName]
+    return sax_4D, dicom_4D_paths
 
-    affine = read_affine(series_dicom_header.iloc[series_dicom_header.SliceLocation.argmin()])
+def read_frames(dicom_4D_grid, sax_4D, workers=None, executor='thread'):
+    """ Decode the dicoms in `dicom_4D_grid` (see cine_index) and write each frame into its slot of the 
+        preallocated array `sax_4D` of shape (nx, ny, number_of_slices, number_of_phases). 
+        
+        With `workers=n`, at most n frames are decoded concurrently using `executor` (see folder.worker_pool). 
+        Threads are usually enough since reading is dominated by I/O; processes help with compressed dicoms. 
+        Frames are submitted in windows of 4*n so that only a few decoded frames are held in memory at a time. 
+    """
+    indices   = list(np.ndindex(dicom_4D_grid.shape))
+    filenames = list(dicom_4D_grid.ravel())
+    with folder.worker_pool(workers, executor) as pool:
+        window = len(filenames) if pool is None else 4*(workers or 1)
+        for start in range(0, len(filenames), max(1, window)):
+            if pool is None:
+                frames = map(_read_pixel_array, filenames[start:start+window])
+            else:
+                frames = pool.map(_read_pixel_array, filenames[start:start+window])
 
-    sax_4D = nib.Nifti1Image(sax_4D, affine=affine), 
-    sax_4D.SpacingBetweenSlices = SpacingBetweenSlices
+            for (SliceIndex, InstanceIndex), frame in zip(indices[start:start+window], frames):
+                sax_4D[:,:,SliceIndex,InstanceIndex] = frame
 
-    return sax_4D, dicom_4D_paths
+def _read_pixel_array(filename): return pydicom.read_file(filename).pixel_array
+
+def cine_index(series_dicom_header, slice_order='SliceLocation', positions=None):
+    """ Organize the dicoms of a cine series into a (slice, phase) grid of file names using a single sort and groupby. 
+        Slices are sorted by SliceLocation, or by position along the slice normal if slice_order='position' (see 
+        series_geometry, positions are rounded to 1e-3 mm), and phases by InstanceNumber. 
+
+    Input
+    -----
+    positions : optional array of positions along the slice normal already computed with series_geometry. 
 
-def _string_to_list_of_floats(x): return list(np.array(x.strip("'[].").split(','), dtype=float))
+    Return
+    ------
+    SliceLocations : sorted array of unique slice locations (or positions along the slice normal). 
+
+    dicom_4D_grid  : array of shape (number_of_slices, number_of_phases) with the dicom file names, or None if 
+                     the number of phases is variable across slice locations or a slice location is missing (NaN), 
+                     as in HeaderIndex.series_grid. 
+    """
+    if slice_order == 'position':
+        if positions is None: _, _, positions = series_geometry(series_dicom_header)
+        series_dicom_header = series_dicom_header.assign(SlicePosition=np.round(positions, 3))
+        slice_key = 'SlicePosition'
+    elif slice_order == 'SliceLocation':
+        slice_key = 'SliceLocation'
+    else:
+        raise ValueError("slice_order must be 'SliceLocation' or 'position', got %r" % (slice_order,))
+
+    series_dicom_header = series_dicom_header.sort_values(by=[slice_key, 'InstanceNumber'], kind='stable')
+    if series_dicom_header.duplicated(subset=[slice_key, 'InstanceNumber']).any():
+        raise ValueError('Found multiple dicoms with the same (%s, InstanceNumber)!' % slice_key)
+
+    phases_per_slice = series_dicom_header.groupby(slice_key, sort=True, dropna=False).size()
+    SliceLocations   = phases_per_slice.index.to_numpy()
+    assert phases_per_slice.sum() == len(series_dicom_header)
+
+    if len(np.unique(phases_per_slice)) != 1 or phases_per_slice.index.isna().any():
+        return SliceLocations, None
+
+    dicom_4D_grid = series_dicom_header.FileName.to_numpy().reshape(len(SliceLocations), -1)
+    return SliceLocations, dicom_4D_grid
 
 def read_affine(df):
     """ Read the 4x4 affine matrix from a pandas DataFrame `df` containing dicom header information. 
+        Geometry keys can be either strings (csv headers) or arrays of floats (parquet headers). 
     """
-    SliceThickness          = [df.SliceThickness]
-    PixelSpacing            = _string_to_list_of_floats(df.PixelSpacing)
-    ImageOrientationPatient = _string_to_list_of_floats(df.ImageOrientationPatient)
-    ImagePositionPatient    = _string_to_list_of_floats(df.ImagePositionPatient)
+    affines, _, _ = series_geometry(pd.DataFrame([df]))
+    return affines[0]
 
-    Zooms                   = np.array(PixelSpacing+SliceThickness, dtype=float)
-    ImageOrientationPatient = np.array(ImageOrientationPatient, dtype=float)
-    ImagePositionPatient    = np.array(ImagePositionPatient, dtype=float)
-    
-    ijk2ras = extract_cosines(ImageOrientationPatient)
+def series_geometry(dicoms_header):
+    """ Vectorized geometry of all the dicoms in a header DataFrame `dicoms_header` (e.g., a whole series). 
+
+    Return
+    ------
+    affines   : array of shape (N, 4, 4) with the affine matrix of each dicom (see read_affine). 
+
+    normals   : array of shape (N, 3) with the slice normal (row cosine x column cosine) of each dicom. 
+
+    positions : array of shape (N,) with the ImagePositionPatient of each dicom projected onto its normal, in mm. 
+                Unlike SliceLocation, this increases along the slice direction of the affine. 
+
+    Dicoms with missing geometry keys get NaN values, so that only the rows actually used need to be complete. 
+    """
+    SliceThickness          = dicoms_header.SliceThickness.to_numpy(dtype=float)
+    PixelSpacing            = _column_to_floats(dicoms_header.PixelSpacing, 2)
+    ImageOrientationPatient = _column_to_floats(dicoms_header.ImageOrientationPatient, 6)
+    ImagePositionPatient    = _column_to_floats(dicoms_header.ImagePositionPatient, 3)
+
+    Zooms   = np.concatenate((PixelSpacing, SliceThickness[:,None]), axis=1)
+    normals = np.cross(ImageOrientationPatient[:,:3], ImageOrientationPatient[:,3:])
+
+    # (N, 3, 3) arrays whose rows are the row, column and slice cosines, see extract_cosines. 
+    cosines = np.stack((ImageOrientationPatient[:,:3], ImageOrientationPatient[:,3:], normals), axis=1)
+    ijk2ras = (cosines*np.array([-1,-1,1])).transpose(0, 2, 1)
 
-    ijk2ras = (ijk2ras*np.array([-1,-1,1])).T
-    ImagePositionPatient = ImagePositionPatient*np.array([-1,-1,1])
+    affines = np.zeros((len(dicoms_header), 4, 4))
+    affines[:,:3,:3] = ijk2ras*Zooms[:,None,:]
+    affines[:,:3,3]  = ImagePositionPatient*np.array([-1,-1,1])
+    affines[:,3,3]   = 1
 
-    affine  = np.stack((ijk2ras[:,0]*Zooms[0],
-                        ijk2ras[:,1]*Zooms[1],
-                        ijk2ras[:,2]*Zooms[2],
-                        ImagePositionPatient), axis=1)
+    positions = np.einsum('ij,ij->i', ImagePositionPatient, normals)
 
-    return np.vstack((affine,[[0,0,0,1]])) 
+    return affines, normals, positions
+
+def _column_to_floats(column, width):
+    """ Convert a column of geometry values (strings from csv headers or float arrays from parquet headers) 
+        into an array of shape (N, width). Missing values (None, NaN or empty strings) become rows of NaNs. 
+    """
+    values = np.full((len(column), width), np.nan)
+    for row, value in enumerate(column.tolist()):
+        if isinstance(value, str):
+            value = value.strip("'[].")
+            if value: values[row] = np.array(value.split(','), dtype=float)
+        elif value is not None and not (np.ndim(value) == 0 and pd.isna(value)):
+            values[row] = np.asarray(value, dtype=float)
+    return values
 
 def extract_cosines(ImageOrientationPatient):
     """ Extract the cos(theta) values describing the orientation of the acquisition plane. 
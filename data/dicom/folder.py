@@ -3,11 +3,22 @@
 
 import os
 import glob
+import hashlib
+import pickle
 import pydicom
 import warnings
+import numpy as np
 import pandas as pd
 
-def export_dicom_headers(dicom_dir, savedir, subject_dirs_target=None, max_dataset_size=float("inf"), encode_name=False):
+from contextlib import contextmanager
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from .hierarchy import HeaderIndex, header_file_digest
+from .metrics import get_metrics
+from .work_queue import get_work_queue
+
+def export_dicom_headers(dicom_dir, savedir, subject_dirs_target=None, max_dataset_size=float("inf"), encode_name=False,
+                         workers=None, executor='process', incremental=False, header_format='csv', metrics=None, 
+                         work_queue=None, content_hash=False):
   """Read selected header information from dicoms within a `dicom_dir` folder.
   
      The following first-level subfolders are expected:
@@ -23,6 +34,18 @@ def export_dicom_headers(dicom_dir, savedir, subject_dirs_target=None, max_datas
      All dicoms within each `subject_dir_n` subfolder will be searched, independent of folder structure. 
      If only a few subject_dir_n folders are needed, set subject_dirs_target=['subject_dir_2', 'subject_dir_5'].
      To test this script, use `max_dataset_size=m` to load only a small amount of `m` files for each subject. 
+     To parse the dicoms of each subject in parallel, set `workers=n` (see `make_dataset`). 
+     If incremental=True, the parsed headers are kept in an index file `savedir_index.pkl` next to `savedir`, and 
+     subsequent runs only parse new or modified dicoms. Header files whose content did not change are not rewritten. 
+     Use header_format='parquet' to export typed headers (see write_dicom_headers) instead of csv files. 
+     To record the time, files parsed, bytes read and rejected dicoms of each subject, pass a metrics.RunMetrics 
+     instance as `metrics`. 
+     To split the subjects across several processes or hosts sharing the file system, run export_dicom_headers in 
+     each of them with the same `work_queue` (a work_queue.WorkQueue or the path of its folder). Each subject_dir_n 
+     is then claimed and processed by a single worker (see work_queue.WorkQueue). 
+     Copies of the same dicom (same SOPInstanceUID) within a subject_dir_n are only read once; with content_hash=True 
+     copies are recognized from their content before parsing (see make_dataset). Dropped copies are listed in 
+     savedir/subject_dir_n_dicoms_duplicates.csv. 
 
   Exports
   -------
@@ -36,53 +59,252 @@ def export_dicom_headers(dicom_dir, savedir, subject_dirs_target=None, max_datas
 
                   If encode_name=False, the entire name without sex will be used, i.e., YYYY_MM_DD_SubjectName_dicoms_headers.csv
 
+                  If header_format='parquet', the files are named YYYY_MM_DD_FNLNS_dicoms_headers.parquet instead. 
+
   """
+  assert header_format in HEADER_FORMATS, 'header_format must be one of %s' % list(HEADER_FORMATS)
   os.makedirs(savedir, exist_ok=True)
 
   subject_dirs = sorted(glob.glob(os.path.join(dicom_dir, '*')))
 
-  for subject_dir in subject_dirs:
-    
-    subject_folder = os.path.basename(subject_dir)
-    if subject_dirs_target is not None:
-      if not any([subject_folder==subject_dir_n for subject_dir_n in subject_dirs_target]): continue
-    print('Reading:', subject_folder)
-
-   # try:
-    dicoms_headers_folder = make_dataset(dir=subject_dir, max_dataset_size=max_dataset_size)
-
-    # ideally there should be a single subject within each folder, but this is not always the case. One could 
-    # reject the folder altogether all try to remove the incorrectly named subject (e.g., `Retro Recon`)
-    for PatientName in dicoms_headers_folder.PatientName.unique():
-      dicoms_headers = dicoms_headers_folder[dicoms_headers_folder.PatientName==PatientName]
-
-      assert len(dicoms_headers.PatientName.unique()) == 1
-      assert len(dicoms_headers.PatientSex.unique()) == 1
-      assert len(dicoms_headers.StudyDate.unique()) == 1
-
-      if encode_name:
-        PatientSex = dicoms_headers.PatientSex.unique().item()
-        PatientLastName, PatientFirstName = dicoms_headers.PatientName.unique().item().split(' ')[:2]
-        PatientEncode = PatientFirstName[:2]+PatientLastName[:2]+PatientSex
-      else:
-        PatientEncode = dicoms_headers.PatientName.unique().item()
+  index_path = os.path.normpath(savedir) + '_index.pkl'
+  cache = load_header_index(index_path) if incremental else None
+  metrics = get_metrics(metrics)
+  if work_queue is not None:
+    work_queue = get_work_queue(work_queue)
+    subject_folders = [os.path.basename(subject_dir) for subject_dir in subject_dirs 
+                       if subject_dirs_target is None or os.path.basename(subject_dir) in subject_dirs_target]
+    subject_dirs = (os.path.join(dicom_dir, subject_folder) for subject_folder in work_queue.claimed(subject_folders))
 
-      StudyDate = dicoms_headers.StudyDate.unique().item()
-      year, month, day = str(int(StudyDate[:4])), str(int(StudyDate[4:6])), str(int(StudyDate[6:]))
+  processed = []
+  try:
+    with metrics.stage('export_headers', dicom_dir=dicom_dir):
+      for subject_dir in subject_dirs:
+        processed += [subject_dir]
+        _export_subject_headers(subject_dir, savedir, subject_dirs_target, max_dataset_size, encode_name, 
+                                workers, executor, cache, header_format, metrics, content_hash)
+  finally:
+    if incremental and work_queue is None: 
+      save_header_index(index_path, _prune_deleted_subjects(cache, dicom_dir))
+    elif incremental:
+      # other workers update the index concurrently, only the entries of the processed subjects are replaced. 
+      with work_queue.locked('header_index'):
+        index = _merge_header_index(load_header_index(index_path), cache, processed)
+        save_header_index(index_path, _prune_deleted_subjects(index, dicom_dir))
+
+def _export_subject_headers(subject_dir, savedir, subject_dirs_target, max_dataset_size, encode_name, 
+                            workers, executor, cache, header_format, metrics, content_hash):
+  """ Export the header files of a single `subject_dir`, see export_dicom_headers. 
+  """
+  
+  subject_folder = os.path.basename(subject_dir)
+  if subject_dirs_target is not None:
+    if not any([subject_folder==subject_dir_n for subject_dir_n in subject_dirs_target]): return
+  print('Reading:', subject_folder)
+
+  with metrics.stage('scan', subject=subject_folder):
+    _export_subject_patients(subject_dir, savedir, max_dataset_size, encode_name, workers, executor, cache, 
+                             header_format, metrics, content_hash)
+
+def _export_subject_patients(subject_dir, savedir, max_dataset_size, encode_name, workers, executor, cache, 
+                             header_format, metrics, content_hash):
+  """ Scan a single `subject_dir` and export the header files of each patient found, see export_dicom_headers. 
+  """
+ # try:
+  duplicates = []
+  dicoms_headers_folder, headers_index = make_dataset(dir=subject_dir, max_dataset_size=max_dataset_size, 
+                                                      workers=workers, executor=executor, cache=cache, 
+                                                      return_index=True, metrics=metrics, 
+                                                      content_hash=content_hash, duplicates=duplicates)
+  duplicates_path = os.path.join(savedir, os.path.basename(subject_dir) + DUPLICATES_SUFFIX)
+  if duplicates:
+    print('Dropped %d duplicate dicoms' % len(duplicates))
+    pd.DataFrame(duplicates, columns=['FileName', 'KeptFileName']).to_csv(duplicates_path, index=False)
+  elif os.path.isfile(duplicates_path):
+    os.remove(duplicates_path)
+
+  # ideally there should be a single subject within each folder, but this is not always the case. One could 
+  # reject the folder altogether all try to remove the incorrectly named subject (e.g., `Retro Recon`)
+  for patient in range(headers_index.n_groups('PatientName')):
+    dicoms_headers = dicoms_headers_folder.iloc[np.sort(headers_index.group_rows('PatientName', patient))]
+
+    assert len(dicoms_headers.PatientName.unique()) == 1
+    assert len(dicoms_headers.PatientSex.unique()) == 1
+    assert len(dicoms_headers.StudyDate.unique()) == 1
+
+    if encode_name:
+      PatientSex = dicoms_headers.PatientSex.unique().item()
+      PatientLastName, PatientFirstName = dicoms_headers.PatientName.unique().item().split(' ')[:2]
+      PatientEncode = PatientFirstName[:2]+PatientLastName[:2]+PatientSex
+    else:
+      PatientEncode = dicoms_headers.PatientName.unique().item()
+
+    StudyDate = dicoms_headers.StudyDate.unique().item()
+    year, month, day = str(int(StudyDate[:4])), str(int(StudyDate[4:6])), str(int(StudyDate[6:]))
+
+    # PatientID should have format YYYY_MM_DD_FNLNS
+    PatientID = '_'.join([year, month, day, PatientEncode]).upper()
+
+    dicoms_headers['PatientID'] = PatientID
+    content = _header_content(dicoms_headers, header_format)
+    if _write_if_changed(os.path.join(savedir, PatientID) + HEADER_FORMATS[header_format], content):
+      metrics.count('bytes_written', len(content))
+      print('Exported dicoms_headers.%s of shape' % header_format, dicoms_headers.shape)
+    else:
+      print('Unchanged dicoms_headers.%s of shape' % header_format, dicoms_headers.shape)
+
+    # the index of the patient is saved next to its header file (after it), with the digest of the header file so 
+    # that it is only reused for the same header file, see read_header_hierarchy. 
+    patient_index = headers_index.subset('PatientName', patient)
+    patient_index.digest = header_file_digest(content)
+    _write_if_changed(os.path.join(savedir, PatientID) + HIERARCHY_SUFFIX, patient_index.to_bytes())
+
+    #except:
+    #  warnings.warn('============== Could not read dicoms in folder %s =============== '%(subject_folder))
+
+# suffix of the exported header files for each header format. 
+HEADER_FORMATS = {'csv': '_dicoms_headers.csv', 'parquet': '_dicoms_headers.parquet'}
+
+# typed columns of the parquet header files, everything else is stored as strings. 
+_FLOAT_ARRAY_KEYS = ['ImageOrientationPatient', 'ImagePositionPatient', 'PixelSpacing']
+_FLOAT_KEYS       = ['SeriesTime', 'AcquisitionTime', 'TriggerTime', 'SliceLocation', 'SliceThickness', 'SpacingBetweenSlices']
+_INT_KEYS         = ['InstanceNumber', 'Rows', 'Columns']
+
+def write_dicom_headers(dicoms_headers, save_prefix, header_format='csv'):
+  """ Write the `dicoms_headers` DataFrame to `save_prefix` + HEADER_FORMATS[header_format]. 
+      The file is not rewritten if its content did not change. Returns True if the file was written. 
+
+      header_format='csv'     : plain text file, multi-valued keys (e.g., PixelSpacing) are stored as strings.
+      header_format='parquet' : typed columnar file (requires pyarrow). Geometry keys are stored as arrays of floats, 
+                                times and locations as floats and InstanceNumber as integers, so that reading back 
+                                the file (see read_dicom_headers) requires no parsing. 
+  """
+  return _write_if_changed(save_prefix + HEADER_FORMATS[header_format], _header_content(dicoms_headers, header_format))
 
-      # PatientID should have format YYYY_MM_DD_FNLNS
-      PatientID = '_'.join([year, month, day, PatientEncode]).upper()
+def _header_content(dicoms_headers, header_format):
+  """ Returns the bytes of the header file of `dicoms_headers` in `header_format`, see write_dicom_headers. 
+  """
+  if header_format == 'csv':
+    return dicoms_headers.to_csv().encode('utf-8')
+  if header_format == 'parquet':
+    return _typed_headers(dicoms_headers).to_parquet()
+  raise ValueError('header_format must be one of %s, got %r' % (list(HEADER_FORMATS), header_format))
+
+# suffix of the list of duplicate dicoms dropped in each subject folder, see make_dataset. 
+DUPLICATES_SUFFIX = '_dicoms_duplicates.csv'
+
+# suffix of the Patient -> Study -> Series -> Slice -> Phase index saved next to each header file. 
+HIERARCHY_SUFFIX = '_dicoms_hierarchy.pkl'
+
+def read_header_hierarchy(path, dicoms_headers):
+  """ Returns the HeaderIndex of the header file `path` read as `dicoms_headers`. The index saved next to the 
+      header file is used if it exists and its digest matches the bytes of the header file on disk (same rows with 
+      the same values), otherwise it is built from `dicoms_headers`. 
+  """
+  hierarchy_path = os.path.join(os.path.dirname(path), header_patient_id(path) + HIERARCHY_SUFFIX)
+  if os.path.isfile(hierarchy_path):
+    headers_index = HeaderIndex.load(hierarchy_path)
+    with open(path, 'rb') as f:
+      if headers_index.digest is not None and headers_index.digest == header_file_digest(f.read()): 
+        return headers_index
+  return HeaderIndex.from_headers(dicoms_headers)
+
+def read_dicom_headers(path):
+  """ Read a header file exported by export_dicom_headers into a pandas DataFrame. The format is 
+      selected from the file extension (see HEADER_FORMATS). 
+  """
+  if path.endswith(HEADER_FORMATS['parquet']):
+    return pd.read_parquet(path)
+  return pd.read_csv(path, index_col=0)
 
-      dicoms_headers['PatientID'] = PatientID
-      dicoms_headers.to_csv(os.path.join(savedir, PatientID + '_' + 'dicoms_headers.csv'))
-      print('Exported dicoms_headers.csv of shape', dicoms_headers.shape)
+def list_header_files(headers_dir):
+  """ List the header files exported by export_dicom_headers in `headers_dir`. 
+  """
+  return [path for path in glob.glob(os.path.join(headers_dir, '*')) if path.endswith(tuple(HEADER_FORMATS.values()))]
 
-      #except:
-      #  warnings.warn('============== Could not read dicoms in folder %s =============== '%(subject_folder))
+def header_patient_id(path):
+  """ Returns the PatientID of a header file exported by export_dicom_headers. 
+  """
+  filename = os.path.basename(path)
+  for suffix in HEADER_FORMATS.values():
+    if filename.endswith(suffix): return filename[:-len(suffix)]
+  return filename
 
+def _typed_headers(dicoms_headers):
+  """ Convert the columns of `dicoms_headers` to the types stored in the parquet header files. 
+  """
+  typed = {}
+  for key, column in dicoms_headers.items():
+    if key in _FLOAT_ARRAY_KEYS:
+      typed[key] = [None if value is None else np.asarray(value, dtype=float) for value in column]
+    elif key in _FLOAT_KEYS:
+      typed[key] = pd.to_numeric(column, errors='coerce').astype(float)
+    elif key in _INT_KEYS:
+      typed[key] = pd.to_numeric(column, errors='coerce').astype('Int64')
+    else:
+      typed[key] = [None if value is None else str(value) for value in column]
+  return pd.DataFrame(typed, index=dicoms_headers.index)
+
+def _write_if_changed(path, content):
+  """ Write the bytes `content` to `path` unless the file already has the same content. Returns True if written. 
+      The file is replaced atomically. 
+  """
+  if os.path.isfile(path):
+    with open(path, 'rb') as f:
+      if f.read() == content: return False
+  with open(path + '.tmp', 'wb') as f:
+    f.write(content)
+  os.replace(path + '.tmp', path)
+  return True
+
+def load_header_index(index_path):
+  """ Load the header index written by save_header_index, or an empty index if `index_path` does not exist. 
+      The index maps each dicom path to (size, mtime, is_valid, header) as returned by os.stat and is_valid_dicom. 
+      An index saved with other header keys than _init_header() (e.g., by an older version) is discarded, so that 
+      all dicoms are parsed again. 
+  """
+  if not os.path.isfile(index_path): return {}
+  with open(index_path, 'rb') as f:
+    state = pickle.load(f)
+  if not isinstance(state, dict) or state.get('schema') != _header_schema():
+    print('Header index was saved with other header keys, all dicoms are parsed again:', index_path)
+    return {}
+  return state['index']
+
+def save_header_index(index_path, index):
+  """ Save the header `index` (see load_header_index) to `index_path` with the header keys it was parsed with. 
+      The file is replaced atomically. 
+  """
+  with open(index_path + '.tmp', 'wb') as f:
+    pickle.dump({'schema': _header_schema(), 'index': index}, f, protocol=pickle.HIGHEST_PROTOCOL)
+  os.replace(index_path + '.tmp', index_path)
       
+def _merge_header_index(index, cache, subject_dirs):
+  """ Replace the entries of `index` under each of `subject_dirs` by those of `cache`. Returns the updated index. 
+  """
+  if not subject_dirs: return index
+  prefixes = tuple(os.path.join(subject_dir, '') for subject_dir in subject_dirs)
+  for filename in [filename for filename in index if filename.startswith(prefixes)]:
+    del index[filename]
+  index.update({filename: entry for filename, entry in cache.items() if filename.startswith(prefixes)})
+  return index
+
+def _prune_deleted_subjects(index, dicom_dir):
+  """ Remove the entries of `index` under `dicom_dir` whose subject folder no longer exists. Returns the index. 
+  """
+  prefix  = os.path.join(dicom_dir, '')
+  deleted = {}
+  for filename in [filename for filename in index if filename.startswith(prefix)]:
+    subject_folder = filename[len(prefix):].split(os.sep)[0]
+    if subject_folder not in deleted:
+      deleted[subject_folder] = not os.path.isdir(os.path.join(dicom_dir, subject_folder))
+    if deleted[subject_folder]: del index[filename]
+  return index
+
 def make_dataset(dir, max_dataset_size=float("inf"), 
-                 ext_exclude=['.json','.nii.gz', '.bvec', '.bval', '.DS_Store']):
+                 ext_exclude=['.json','.nii.gz', '.bvec', '.bval', '.DS_Store'],
+                 workers=None, executor='process', cache=None, return_index=False, metrics=None, 
+                 deduplicate=True, content_hash=False, duplicates=None):
   """ Create a pandas DataFrame containing header information from all dicoms withint a `dir`. 
       Header information includes the dicom `filename` and `PatientName` to facility querying and loading. 
 
@@ -95,6 +317,30 @@ def make_dataset(dir, max_dataset_size=float("inf"),
   ext_exclude : list of strings indicating file extensions. This is useful to skip non-dicom files present in 
                 the folder. The default includes common extensions found along dicom files. 
 
+  workers : int, number of workers used to parse the dicoms. If None (default), the dicoms are parsed serially.
+
+  executor : 'process', 'thread' or a concurrent.futures.Executor instance used when `workers` is set. Processes 
+             spread the parsing over CPU cores; threads are cheaper to start and are enough on slow network storage. 
+             The output is the same as in the serial case, including the sort order and `max_dataset_size` cut-off.
+
+  cache : dictionary mapping dicom paths to (size, mtime, is_valid, header), see load_header_index. If given, only 
+          dicoms not in the cache or whose size or modification time changed are parsed. The cache is updated in 
+          place, and entries of files under `dir` that no longer exist are removed. 
+
+  return_index : if True, also return the Patient -> Study -> Series -> Slice -> Phase HeaderIndex of the headers. 
+
+  metrics : optional metrics.RunMetrics counting the files listed, parsed and cached, the bytes parsed from the 
+            headers of the parsed files (`bytes_read`, reading stops before the pixel data) and the rejected dicoms by reason (InlineVF, Secondary, unreadable or duplicate). 
+
+  deduplicate : if True (default), dicoms whose SOPInstanceUID was already found (e.g., the same dicoms copied 
+                into several subfolders) are dropped. The first file found is kept. Dicoms with a missing or 
+                empty SOPInstanceUID are never dropped. 
+
+  content_hash : if True, duplicate files are also recognized by their content_digest before their header is 
+                 parsed, so that copies are not parsed at all. This reads the first and last blocks of each file. 
+
+  duplicates : optional list to which a (duplicate, kept) pair of file names is appended for each dropped dicom. 
+
   Returns
   -------
   headers : pandas DataFrame with dicom header information sorted by dicoms filenames. Sorting is important
@@ -102,30 +348,153 @@ def make_dataset(dir, max_dataset_size=float("inf"),
   """
   assert os.path.isdir(dir), '%s is not a valid directory' % dir
 
-  headers = pd.DataFrame(_init_header())
-  for root, _, fnames in os.walk(dir):
-      for fname in fnames:
-          if fname.endswith(tuple(ext_exclude)): continue
-
-          is_valid, header = is_valid_dicom(os.path.join(root, fname))
-
-          if is_valid:
-              if isinstance(header, str):
-                print('Dicom is not valid:', header, os.path.join(root, fname))
-              else:
-                headers = pd.concat((headers, header))
-          else:
-              print('Could not open/read file:', os.path.join(root, fname))
-          
-          if len(headers) == max_dataset_size: 
-              return headers
+  metrics   = get_metrics(metrics)
+  filenames = _list_files(dir, ext_exclude)
+  metrics.count('files_listed', len(filenames))
+
+  if cache is None:
+    stale = filenames
+  else:
+    stats = _prune_cache(cache, dir, filenames)
+    stale = [filename for filename in filenames if cache.get(filename, (None, None))[:2] != stats[filename]]
+  stale_set = set(stale)
+
+  # headers are accumulated column-wise and converted to a DataFrame only once at the end. 
+  headers = _init_header()
+  n_headers = 0
+  found     = {}
+  with worker_pool(workers, executor) as pool:
+    copies = _content_copies(stale, pool) if deduplicate and content_hash else {}
+    stale  = [filename for filename in stale if filename not in copies]
+    results = map(_scan_dicom, stale) if pool is None else pool.map(_scan_dicom, stale, chunksize=64)
+
+    for filename in filenames:
+        if filename in copies:
+            _drop_duplicate(filename, copies[filename], duplicates, metrics)
+            continue
+
+        if filename in stale_set:
+            is_valid, header, n_bytes = next(results)
+            if cache is not None: cache[filename] = stats[filename] + (is_valid, header)
+            metrics.count('files_parsed')
+            metrics.count('bytes_read', n_bytes)
+        else:
+            is_valid, header = cache[filename][2:]
+            metrics.count('files_cached')
+
+        if is_valid:
+            if isinstance(header, str):
+              print('Dicom is not valid:', header, filename)
+              metrics.reject(header)
+            elif deduplicate and header['SOPInstanceUID'] and header['SOPInstanceUID'] in found:
+              _drop_duplicate(filename, found[header['SOPInstanceUID']], duplicates, metrics)
+            else:
+              _append_header(headers, header)
+              n_headers += 1
+              # missing or empty UIDs (e.g., written by anonymizers) do not identify copies. 
+              if deduplicate and header['SOPInstanceUID']: found[header['SOPInstanceUID']] = filename
+        else:
+            print('Could not open/read file:', filename)
+            metrics.reject('unreadable')
+        
+        if n_headers == max_dataset_size: 
+            return _headers_and_index(_sorted_headers(headers), return_index)
               
-  return headers.sort_values(by='FileName')
+  return _headers_and_index(_sorted_headers(headers), return_index)
+
+def _content_copies(filenames, pool=None):
+  """ Returns a dictionary mapping each file of `filenames` whose content_digest was already found to the first 
+      file with the same digest. 
+  """
+  digests = map(content_digest, filenames) if pool is None else pool.map(content_digest, filenames, chunksize=64)
+  found, copies = {}, {}
+  for filename, digest in zip(filenames, digests):
+    if digest is None: continue
+    if digest in found:
+      copies[filename] = found[digest]
+    else:
+      found[digest] = filename
+  return copies
+
+def content_digest(filename, block_size=64*1024):
+  """ Fast digest of a file from its size and its first and last `block_size` bytes, which contain the header 
+      (with the SOPInstanceUID) and the end of the pixel data of a dicom. Returns None if the file cannot be read. 
+  """
+  try:
+    with open(filename, 'rb') as f:
+      size   = os.fstat(f.fileno()).st_size
+      digest = hashlib.blake2b(str(size).encode('utf-8'), digest_size=16)
+      digest.update(f.read(block_size))
+      if size > 2*block_size: f.seek(-block_size, os.SEEK_END)
+      digest.update(f.read(block_size))
+  except OSError:
+    return None
+  return digest.hexdigest()
+
+def _drop_duplicate(filename, kept, duplicates, metrics):
+  print('Duplicate dicom:', filename, 'of', kept)
+  metrics.reject('duplicate')
+  if duplicates is not None: duplicates.append((filename, kept))
+
+def _sorted_headers(headers):
+  """ DataFrame of the accumulated `headers` sorted by FileName, indexed 0..N-1 so that the exported header files 
+      do not depend on the listing order of the dicoms. 
+  """
+  return pd.DataFrame(headers).sort_values(by='FileName').reset_index(drop=True)
+
+def _headers_and_index(headers, return_index):
+  if not return_index: return headers
+  return headers, HeaderIndex.from_headers(headers)
+
+def _prune_cache(cache, dir, filenames):
+  """ Remove the `cache` entries of files under `dir` missing from `filenames`. Returns the (size, mtime) of `filenames`. 
+  """
+  stats  = {}
+  for filename in filenames:
+    stat = os.stat(filename)
+    stats[filename] = (stat.st_size, stat.st_mtime_ns)
+
+  prefix = os.path.join(dir, '')
+  for filename in [filename for filename in cache if filename.startswith(prefix) and filename not in stats]:
+    del cache[filename]
+  return stats
+
+def _list_files(dir, ext_exclude):
+  """ List the files within `dir` in `os.walk` order, skipping files with extensions in `ext_exclude`. 
+  """
+  return [os.path.join(root, fname) for root, _, fnames in os.walk(dir) 
+                                    for fname in fnames if not fname.endswith(tuple(ext_exclude))]
+
+@contextmanager
+def worker_pool(workers, executor):
+  """ Context manager yielding the executor used to read dicoms, or None for serial reading. 
+      `executor` is 'process', 'thread' or a concurrent.futures.Executor instance, and `workers` is the maximum 
+      number of concurrent workers. Executors created here are shut down on exit, cancelling pending work 
+      (e.g., after `max_dataset_size` is reached); executors passed by the caller are left running. 
+  """
+  if isinstance(executor, Executor):
+    yield executor
+    return
+  if workers is None:
+    yield None
+    return
+  if executor == 'process':
+    pool = ProcessPoolExecutor(max_workers=workers)
+  elif executor == 'thread':
+    pool = ThreadPoolExecutor(max_workers=workers)
+  else:
+    raise ValueError("executor must be 'process', 'thread' or a concurrent.futures.Executor, got %r" % (executor,))
+  try:
+    yield pool
+  finally:
+    pool.shutdown(wait=True, cancel_futures=True)
 
 def is_valid_dicom(filename):
   """ Verifies:
        (1) a dicom can be loaded using pydicom.read_file(filename)
        (2) the dicom contains primary data (i.e., it rejects dicoms processsed by Siemens in-line) 
+
+      Only the header keys in _init_header() are read; reading stops before the pixel data. 
   
   Returns
   -------
@@ -133,37 +502,65 @@ def is_valid_dicom(filename):
 
   dicom    : if valid dicom returns dicom header, otherwise returns reason for not valid. 
   """
+  return _scan_dicom(filename)[:2]
+
+def _scan_dicom(filename):
+  """ Returns is_valid_dicom(filename) and the number of bytes of the file parsed, i.e. the offset where reading 
+      stopped (before the pixel data). 
+  """
+  n_bytes = 0
   try:
-    dicom = pydicom.read_file(filename)     
+    with open(filename, 'rb') as f:
+      try:
+        dicom = pydicom.read_file(f, stop_before_pixels=True, specific_tags=_header_tags())     
+      finally:
+        n_bytes = f.tell()
     # ADDITIONAL TECHNICAL CHECKS
     # remove siemens segmentation outputs. 
-    if 'InlineVF' in dicom.SeriesDescription: return True, 'InlineVF'
+    if 'InlineVF' in dicom.SeriesDescription: return True, 'InlineVF', n_bytes
     # check images come primary  data (i.e., MR or CT scanners)
-    if 'Secondary' in dicom.file_meta[0x0002, 0x0002].repval: return True, 'Secondary'
+    if 'Secondary' in dicom.file_meta[0x0002, 0x0002].repval: return True, 'Secondary', n_bytes
 
     
   except:
-      return False, None
+      return False, None, n_bytes
 
-  return True, read_header(dicom, filename)
+  return True, read_header(dicom, filename), n_bytes
 
 def read_header(dicom, filename):
-  """ Reads selected dicom keys as specified in _init_header() into a pandas DataFrame. 
-      The `filename` of the dicom is included in the DataFrame for downstream quality control.
+  """ Reads selected dicom keys as specified in _init_header() into a dictionary with one value per key. 
+      The `filename` of the dicom is included in the header for downstream quality control.
   """
 
-  header = _init_header()
+  header = dict.fromkeys(_init_header())
 
-  header['FileName']    += [filename]
-  header['PatientName'] += [str(dicom[0x0010, 0x0010].value).replace('^', ' ')]
+  header['FileName']    = filename
+  header['PatientName'] = str(dicom[0x0010, 0x0010].value).replace('^', ' ')
   for key in header.keys():
     if key not in ['FileName', 'PatientName']:
       try:
-        header[key] += [dicom[key].value]
+        header[key] = dicom[key].value
       except:
-        header[key] += [None]
+        header[key] = None
 
-  return pd.DataFrame(header)
+  return header
+
+def _append_header(headers, header):
+  """ Appends a single `header` (see read_header) to the columns of `headers` (see _init_header). 
+  """
+  for key, column in headers.items():
+    column.append(header[key])
+
+def _header_tags():
+  """ Returns the dicom keywords read by is_valid_dicom, i.e., the keys of _init_header() except `FileName`. 
+      The file meta information (e.g., the SOP class used to reject `Secondary` dicoms) is always read. 
+  """
+  return [key for key in _init_header() if key != 'FileName']
+
+def _header_schema():
+  """ Returns the header keys of _init_header(), saved with the header index to detect stale cached headers. 
+  """
+  return tuple(_init_header())
 
 def _init_header():
   """ Returns empty dictionary of selected dicom keys (e.g., PatientSex, StudyDate, SeriesDescription). 
@@ -189,6 +586,8 @@ def _init_header():
             'SliceLocation':[], 
             'PixelSpacing':[], 
             'SliceThickness':[], 
-            'SpacingBetweenSlices':[]}
+            'SpacingBetweenSlices':[],
+            'Rows':[],
+            'Columns':[]}
 
   return header
\ No newline at end of file
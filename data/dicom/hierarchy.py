@@ -0,0 +1,160 @@
+# Manuel A. Morales, PhD (mmorale5@bidmc.harvard.edu)
+# CMR Enthusiast
+
+import pickle
+import hashlib
+import numpy as np
+import pandas as pd
+
+# levels of the Patient -> Study -> Series -> Slice -> Phase hierarchy, as dicom header keys.
+LEVELS = ('PatientName', 'StudyInstanceUID', 'SeriesInstanceUID', 'SliceLocation', 'InstanceNumber')
+
+class HeaderIndex:
+  """ Array-backed Patient -> Study -> Series -> Slice -> Phase index of a dicom header DataFrame.
+
+      The rows of the DataFrame are sorted once by the integer codes of each level (see LEVELS). Every group of a
+      level (e.g., a series) is then a contiguous range of the sorted rows, stored as offsets, so that the rows of
+      any group and its child groups are found without scanning the DataFrame again. Row numbers refer to
+      positions in the DataFrame (i.e., `headers.iloc[rows]`).
+
+  Attributes
+  ----------
+  levels  : tuple of header keys, one per level.
+
+  labels  : list with the sorted unique values of each level.
+
+  codes   : array of shape (N, n_levels) with the code of each sorted row at each level, i.e. labels[level][code].
+
+  order   : array of shape (N,) with the DataFrame position of each sorted row.
+
+  offsets : list with, for each level, the start of each group in the sorted rows followed by N.
+
+  digest  : header_file_digest of the header file the row numbers refer to, or None if unknown. 
+  """
+  def __init__(self, levels, labels, codes, order, digest=None):
+    self.levels  = tuple(levels)
+    self.labels  = list(labels)
+    self.codes   = codes
+    self.order   = order
+    self.offsets = _group_offsets(codes)
+    self.digest  = digest
+
+    # first child group of each group, and group number of each series for O(1) lookups.
+    self.child_offsets = [np.searchsorted(self.offsets[level+1], self.offsets[level])
+                          for level in range(len(self.levels)-1)]
+    self._series = {}
+    if 'SeriesInstanceUID' in self.levels:
+      for group, label in enumerate(self.group_labels('SeriesInstanceUID')):
+        self._series.setdefault(label, group)
+
+  @classmethod
+  def from_headers(cls, headers, levels=LEVELS):
+    """ Build the index of a dicom header DataFrame `headers` with a single sort.
+    """
+    labels, codes = [], []
+    for key in levels:
+      level_codes, level_labels = pd.factorize(headers[key].to_numpy(), sort=True, use_na_sentinel=False)
+      labels += [np.asarray(level_labels)]
+      codes  += [level_codes]
+    codes = np.stack(codes, axis=1).astype(np.int32) if len(headers) else np.zeros((0, len(levels)), dtype=np.int32)
+
+    order = np.lexsort(codes.T[::-1])
+    return cls(levels, labels, codes[order], order)
+
+  def level(self, level):
+    """ Returns the position of `level` (a header key or position) in the hierarchy.
+    """
+    return self.levels.index(level) if isinstance(level, str) else level
+
+  def n_groups(self, level):
+    return len(self.offsets[self.level(level)]) - 1
+
+  def group_labels(self, level):
+    """ Returns the value of the `level` key for each group of that level.
+    """
+    level = self.level(level)
+    return self.labels[level][self.codes[self.offsets[level][:-1], level]]
+
+  def group_rows(self, level, group):
+    """ Returns the DataFrame positions of the rows in `group` of `level`, in hierarchy order.
+    """
+    level = self.level(level)
+    return self.order[self.offsets[level][group]:self.offsets[level][group+1]]
+
+  def children(self, level, group):
+    """ Returns the range of groups of the next level contained in `group` of `level`.
+    """
+    level = self.level(level)
+    return range(self.child_offsets[level][group], self.child_offsets[level][group+1])
+
+  def series(self, SeriesInstanceUID):
+    """ Returns the group number of a series, or None if the series is not in the index.
+    """
+    return self._series.get(SeriesInstanceUID)
+
+  def series_grid(self, group):
+    """ Returns the (slice, phase) grid of DataFrame positions of series `group`, with slices and phases sorted by
+        the slice and phase levels. Returns None if the number of phases is variable across slices, if a slice
+        label is missing (NaN or None) or if a (slice, phase) has several dicoms, as in convert.cine_index.
+    """
+    series_level, slice_level, phase_level = [self.level(key) for key in self.levels[-3:]]
+    slices = self.children(series_level, group)
+    if len(slices) == 0: return None
+    if pd.isna(self.group_labels(slice_level)[slices.start:slices.stop]).any(): return None
+
+    rows_per_slice   = np.diff(self.offsets[slice_level][slices.start:slices.stop+1])
+    phases_per_slice = np.diff(self.child_offsets[slice_level][slices.start:slices.stop+1])
+    if (rows_per_slice != phases_per_slice).any() or len(np.unique(phases_per_slice)) != 1: return None
+
+    start, stop = self.offsets[slice_level][slices.start], self.offsets[slice_level][slices.stop]
+    return self.order[start:stop].reshape(len(slices), -1)
+
+  def subset(self, level, group):
+    """ Returns the index of the rows in `group` of `level`. Row numbers refer to positions within these rows
+        taken in DataFrame order, i.e. `headers.iloc[np.sort(index.group_rows(level, group))]`. Its digest is 
+        unknown (None) until set from the header file of these rows. 
+    """
+    level = self.level(level)
+    start, stop = self.offsets[level][group], self.offsets[level][group+1]
+    rows  = self.order[start:stop]
+    order = np.empty_like(rows)
+    order[np.argsort(rows, kind='stable')] = np.arange(len(rows))
+    return HeaderIndex(self.levels, self.labels, self.codes[start:stop], order)
+
+  def to_bytes(self):
+    return pickle.dumps({'levels': self.levels, 'labels': self.labels, 'codes': self.codes, 'order': self.order, 
+                         'digest': self.digest}, protocol=pickle.HIGHEST_PROTOCOL)
+
+  @classmethod
+  def from_bytes(cls, content):
+    state = pickle.loads(content)
+    return cls(state['levels'], state['labels'], state['codes'], state['order'], state.get('digest'))
+
+  def save(self, path):
+    with open(path, 'wb') as f:
+      f.write(self.to_bytes())
+
+  @classmethod
+  def load(cls, path):
+    with open(path, 'rb') as f:
+      return cls.from_bytes(f.read())
+
+  def __len__(self):
+    return len(self.order)
+
+def header_file_digest(content):
+  """ Digest of the bytes `content` of a header file, identifying the rows (and their values) an index refers to. 
+  """
+  return hashlib.sha1(content).hexdigest()
+
+def _group_offsets(codes):
+  """ Returns the start of each group of the sorted `codes` at every level, followed by the number of rows.
+      A new group starts at a level whenever the code of that level or of any parent level changes.
+  """
+  n_rows, n_levels = codes.shape
+  new_group = np.logical_or.accumulate(codes[1:] != codes[:-1], axis=1) if n_rows > 1 else np.zeros((0, n_levels), bool)
+  offsets = []
+  for level in range(n_levels):
+    starts = np.flatnonzero(new_group[:, level]) + 1
+    offsets += [np.concatenate(([0] if n_rows else [], starts, [n_rows])).astype(np.int64)]
+  return offsets
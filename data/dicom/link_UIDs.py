@@ -1,9 +1,108 @@
 import os
 import glob
+import pydicom
 import numpy as np
 import pandas as pd
 import nibabel as nib
 
+from .metrics import get_metrics
+from .convert import save_nifti, save_streamed_nifti, nifti_memmap, conversion_jobs, run_conversion_jobs, series_geometry, _estimate_voxels
+
+def export_linked_niftis(headers_dir, 
+                         savedir,
+                         SeriesDescriptionContainsTrues=[], 
+                         SeriesDescriptionContainsFalse=[],
+                         select_subject=None,
+                         min_slices=5,
+                         **kwargs):
+    """ Link single-slice series with different SeriesInstanceUIDs directly from the header files of `headers_dir` 
+        and convert each linked stack to a 4D nifti in `savedir` with a single pass over its dicoms. This replaces 
+        converting every single-slice series to nifti and re-reading them with link_dicoms_with_different_UIDs. 
+
+        Series are selected as in convert._export_niftis and linked with link_single_slice_jobs. Additional `kwargs` 
+        (e.g., workers, streaming, compresslevel, metrics) are passed to convert.run_conversion_jobs. The outputs follow the 
+        layout of convert._export_niftis and are named after the first acquisition of each stack with a `_linked` 
+        suffix (e.g., PatientID_tf2d_linked_AcqTime_..., see _linked_job), so that `savedir` can be shared with 
+        convert._export_niftis without overwriting its single-slice niftis or manifest entries. 
+
+    Return
+    ------
+    failures : dictionary mapping the nifti path of each failed stack to the reason of failure. 
+    """
+    jobs = conversion_jobs(headers_dir, savedir, SeriesDescriptionContainsTrues, SeriesDescriptionContainsFalse, 
+                           select_subject, kwargs.pop('nifti_ext', '.nii.gz'))
+    
+    linked_jobs = link_single_slice_jobs(jobs, min_slices, kwargs.get('slice_order', 'SliceLocation'))
+    return run_conversion_jobs(linked_jobs, savedir, **kwargs)
+
+def link_single_slice_jobs(jobs, min_slices=5, slice_order='SliceLocation'):
+    """ Link the single-slice conversion `jobs` (see convert.conversion_jobs) that belong to a single acquisition. 
+
+        Single-slice series of the same subject, series description and matrix size (rows, columns and phases) are 
+        ordered by AcquisitionTime and stacked until a SliceLocation repeats, in which case a new stack is started. 
+        Stacks with fewer than `min_slices` slices are discarded. With slice_order='position', slices are compared 
+        by their position along the slice normal (see convert.series_geometry) instead of their SliceLocation. 
+
+    Return
+    ------
+    linked_jobs : list of conversion jobs, one for each stack, whose `header` contains the dicoms of all its slices. 
+    """
+    series = {'job':[], 'FileID':[], 'Shape':[], 'AcqTime':[], 'SliceLocation':[]}
+    for job in jobs:
+        header = job['header']
+        if len(header.SliceLocation.unique()) != 1: continue
+
+        series['job']           += [job]
+        series['FileID']        += [job['save_nii'].split('_AcqTime_')[0]]
+        series['Shape']         += [_series_shape(header)]
+        series['AcqTime']       += [min(header.AcquisitionTime)]
+        if slice_order == 'position':
+            series['SliceLocation'] += [np.round(series_geometry(header.iloc[:1])[2][0], 3)]
+        else:
+            series['SliceLocation'] += [header.SliceLocation.iloc[0]]
+    series = pd.DataFrame(series)
+
+    linked_jobs = []
+    for _, shape_df in series.groupby(['FileID', 'Shape'], sort=False):
+        shape_df = shape_df.sort_values(by='AcqTime', kind='stable')
+        stack = []
+        for job, slice_location in zip(shape_df.job, shape_df.SliceLocation):
+            if slice_location in [stack_location for _, stack_location in stack]:
+                linked_jobs += [_linked_job(stack)] if len(stack) >= min_slices else []
+                stack = []
+            stack += [(job, slice_location)]
+        linked_jobs += [_linked_job(stack)] if len(stack) >= min_slices else []
+
+    return linked_jobs
+
+# text following the save name in each output path of a conversion job, see convert.conversion_jobs. 
+_PATH_MARKERS = {'save_nii': '_AcqTime_', 'save_npy': '_slice_locations_AcqTime_', 'save_npy_dic': '_dicom_paths_AcqTime_'}
+
+def _linked_job(stack):
+    """ Conversion job of a stack of (single-slice job, SliceLocation), saved with the paths of its first job 
+        with a `_linked` suffix added to its save name, so that the slice locations and dicom paths are still found 
+        from the FileID of the nifti (e.g., FileID + '_slice_locations_AcqTime_', see convert.conversion_jobs). 
+    """
+    linked_job = dict(stack[0][0])
+    for key, marker in _PATH_MARKERS.items():
+        save_name, AcquisitionTime = linked_job[key].rsplit(marker, 1)
+        linked_job[key] = save_name + '_linked' + marker + AcquisitionTime
+    linked_job['header'] = pd.concat([job['header'] for job, _ in stack])
+    linked_job['voxels'] = _estimate_voxels(linked_job['header'])
+    linked_job['grid']   = None
+    return linked_job
+
+def _series_shape(header):
+    """ Returns the (rows, columns, 1, phases) shape of a single-slice series. Header files exported without 
+        Rows/Columns are completed by reading the header of the first dicom. 
+    """
+    if 'Rows' in header and 'Columns' in header and not header[['Rows', 'Columns']].isna().any().any():
+        rows, columns = header.Rows.iloc[0], header.Columns.iloc[0]
+    else:
+        dicom = pydicom.read_file(header.FileName.iloc[0], stop_before_pixels=True, specific_tags=['Rows', 'Columns'])
+        rows, columns = dicom.Rows, dicom.Columns
+    return (int(rows), int(columns), 1, len(header))
+
 def create_single_slice_dicoms_dataframe(nifti_dir):
     """ Creates a dataframe containing information of single-slice dicoms. This is information is needed 
         to accurately link dicoms that belong to a single acquisition but whose SeriesInstanceUID is different. 
@@ -41,98 +140,137 @@ def create_single_slice_dicoms_dataframe(nifti_dir):
 
     return group_df
 
-def concatenate_dicoms(file_df):
-    """ Concatenate multiple 3D niftis (2D slice + time) into a single 4D nifti
+def concatenate_dicoms(file_df, out_file=None):
+    """ Concatenate multiple 3D niftis (2D slice + time) into a single 4D nifti. 
+        If `out_file` ('.nii') is given, the 4D array is memory-mapped to this file and filled slice by slice 
+        instead of being held in memory (see convert.nifti_memmap). 
+
+        The raw voxel data of each slice is copied into the preallocated output, keeping the on-disk dtype of the 
+        niftis (e.g., uint16). If the niftis share an intensity scaling (scl_slope/scl_inter), the memory-mapped 
+        output keeps the raw data and stores the scaling in its header, while the in-memory output is scaled to 
+        float32 (nibabel does not apply header scaling to in-memory arrays). Both return the same `get_fdata()`. 
+        Niftis with different dtypes or scalings are read as scaled float64 instead. 
     """
 
-    nifti_ref = nib.load(file_df.NiftiPath.iloc[0])
+    niftis    = [nib.load(nifti_path) for nifti_path in file_df.NiftiPath]
+    nifti_ref = niftis[0]
 
     nx, ny, _, n_frames = nifti_ref.shape
 
     n_slices = len(file_df)
 
-    nifti_4D = np.zeros((nx, ny, n_slices, n_frames), dtype=nifti_ref.get_fdata().dtype)
+    native = all(nifti.get_data_dtype() == nifti_ref.get_data_dtype() and 
+                 _slope_inter(nifti) == _slope_inter(nifti_ref) for nifti in niftis)
+    dtype  = nifti_ref.get_data_dtype() if native else np.float64
+    slope_inter = _slope_inter(nifti_ref) if native else (1.0, 0.0)
 
-    for slice_index in range(n_slices):
-        image_slice = nib.load(file_df.NiftiPath.iloc[slice_index]).get_fdata()
-        nifti_4D[:,:,slice_index,:] += image_slice.squeeze()
+    if out_file is None:
+        nifti_4D = np.zeros((nx, ny, n_slices, n_frames), dtype=dtype)
+    else:
+        nifti_4D = nifti_memmap(out_file, (nx, ny, n_slices, n_frames), dtype, nifti_ref.affine, slope_inter)
 
-    nifti_4D = nib.Nifti1Image(nifti_4D, affine=nifti_ref.affine)
+    for slice_index, nifti in enumerate(niftis):
+        image_slice = nifti.dataobj.get_unscaled() if native else nifti.get_fdata()
+        nifti_4D[:,:,slice_index,:] = image_slice.reshape(nx, ny, n_frames)
 
-    return nifti_4D
+    if out_file is None:
+        if slope_inter != (1.0, 0.0): 
+            slope, inter = slope_inter
+            nifti_4D = (nifti_4D * np.float32(slope) + np.float32(inter)).astype(np.float32)
+        return nib.Nifti1Image(nifti_4D, affine=nifti_ref.affine)
 
+    nifti_4D.flush()
+    del nifti_4D
+    return nib.load(out_file)
 
-def link_dicoms_with_different_UIDs(nifti_dir):
+def _slope_inter(nifti):
+    """ Returns the (slope, intercept) intensity scaling of the voxel data of `nifti`, (1.0, 0.0) if unscaled. 
+    """
+    slope, inter = float(nifti.dataobj.slope), float(nifti.dataobj.inter)
+    return (1.0 if np.isnan(slope) or slope == 0 else slope, 0.0 if np.isnan(inter) else inter)
 
-    df = create_single_slice_dicoms_dataframe(nifti_dir)
-    nifti_dir = '/Users/laptop/Desktop/Maaike/MRI_Cines_2_niftis'
+def _save_concatenated(file_df, output_folder, compresslevel=None, gzip_threads=None, streaming=False, metrics=None):
+    """ Concatenate the single-slice niftis of `file_df` and save the 4D nifti in `output_folder` if it contains 
+        at least 5 slices. The file is named after the first nifti of `file_df`. 
+    """
+    if len(file_df) < 5: return
+    metrics = get_metrics(metrics)
+
+    os.makedirs(os.path.join(output_folder, 'nifti2dicom_paths'), exist_ok=True)
+    os.makedirs(os.path.join(output_folder, 'niftis'), exist_ok=True)
+    os.makedirs(os.path.join(output_folder, 'slice_locations'), exist_ok=True)
+
+    save_nii = os.path.join(output_folder, 'niftis', os.path.basename(list(file_df.NiftiPath)[0]))
+    if streaming:
+        out_file = os.path.join(output_folder, 'niftis', '.tmp_%d_stream.nii' % os.getpid())
+        nifti_4D = concatenate_dicoms(file_df, out_file=out_file)
+        shape    = nifti_4D.shape
+        save_streamed_nifti(out_file, save_nii, compresslevel=compresslevel, threads=gzip_threads)
+    else:
+        nifti_4D = concatenate_dicoms(file_df)
+        shape    = nifti_4D.shape
+        save_nifti(nifti_4D, save_nii, compresslevel=compresslevel, threads=gzip_threads)
+
+    metrics.count('niftis_linked', len(file_df))
+    metrics.count('bytes_read', sum(os.path.getsize(nifti_path) for nifti_path in file_df.NiftiPath))
+    metrics.count('bytes_written', os.path.getsize(save_nii))
+    print(shape)
+
+
+def link_dicoms_with_different_UIDs(nifti_dir, compresslevel=None, gzip_threads=None, streaming=False, metrics=None):
+    """ Concatenate single-slice niftis of `nifti_dir` that belong to the same acquisition. The linked niftis are 
+        saved with the given `compresslevel` and `gzip_threads` (see convert.save_nifti). With `streaming=True`, 
+        each linked volume is assembled in a memory-mapped file instead of in memory (see concatenate_dicoms). 
+        With `metrics` (see metrics.RunMetrics), a `link` stage is recorded for each subject. 
+
+        This works on converted niftis; to link series before conversion, use export_linked_niftis. 
+    """
+
+    metrics = get_metrics(metrics)
+    with metrics.stage('list_single_slices', nifti_dir=nifti_dir):
+        df = create_single_slice_dicoms_dataframe(nifti_dir)
     nifti_dir_concat = nifti_dir + '_concatenated_slices'
 
     for SubjectID in df.SubjectID.unique():
+        with metrics.stage('link', subject=SubjectID):
+            _link_subject(df[df.SubjectID==SubjectID], SubjectID, nifti_dir_concat, compresslevel, gzip_threads, 
+                          streaming, metrics)
 
-        # dataframe for dicoms with the same SubjectID
-        subject_df = df[df.SubjectID==SubjectID]
-
-        for FileID in subject_df.FileID.unique():
-            
-            # dicoms with the same FileID and SubjectID
-            file_df = subject_df[subject_df.FileID==FileID].sort_values(by=['AcqTime'])
-            
-            for Shape in file_df.Shape.unique():
-                
-                # dicoms with the same Shape, FileID, and SubjectID
-                shape_df = file_df[file_df.Shape==Shape]
-
-                if len(shape_df) == len(shape_df.SliceLocation.unique()):
-                    # all FileIDs have the same shape with slices at different location, 
-                    # therefore assume all belong to same acquisition
-                    nifti_4D = concatenate_dicoms(shape_df)
-
-                    if nifti_4D.shape[2] >= 5:
-                        # save file
-                        output_folder = os.path.join(nifti_dir_concat, os.path.basename(SubjectID))
-
-                        os.makedirs(os.path.join(output_folder, 'nifti2dicom_paths'), exist_ok=True)
-                        os.makedirs(os.path.join(output_folder, 'niftis'), exist_ok=True)
-                        os.makedirs(os.path.join(output_folder, 'slice_locations'), exist_ok=True)
-
-                        
-                        nifti_4D.to_filename(os.path.join(output_folder, 
-                                                        'niftis', 
-                                                        os.path.basename(list(shape_df.NiftiPath)[0])))
-
-                        print(nifti_4D.shape)
-                else:
-                    # at this point we assume this are likely from the same acquisition. 
-                    # We will loop through them in order of acquisition time; if a slice 
-                    # is repeated then assume is a different acquisition. 
-
-                    slice_locations = []
-                    acquisitions    = []
-                    for index, slice_location in zip(shape_df.index, shape_df.SliceLocation):
-                        
-                        if slice_location not in slice_locations:
-                            slice_locations += [slice_location]
-                            acquisitions    += [shape_df[shape_df.index==index]]
-                        else:
-
-                            nifti_4D = concatenate_dicoms(pd.concat(acquisitions))
-
-                            
-                            if nifti_4D.shape[2] >= 5:
-                                # save file
-                                output_folder = os.path.join(nifti_dir_concat, os.path.basename(SubjectID))
-
-                                os.makedirs(os.path.join(output_folder, 'nifti2dicom_paths'), exist_ok=True)
-                                os.makedirs(os.path.join(output_folder, 'niftis'), exist_ok=True)
-                                os.makedirs(os.path.join(output_folder, 'slice_locations'), exist_ok=True)
-
-                                
-                                nifti_4D.to_filename(os.path.join(output_folder, 
-                                                                'niftis', 
-                                                                os.path.basename(acquisitions[0].NiftiPath.item())))
-    
-                                print(nifti_4D.shape)
-                            
-                            slice_locations = []
-                            acquisitions    = []
\ No newline at end of file
+def _link_subject(subject_df, SubjectID, nifti_dir_concat, compresslevel, gzip_threads, streaming, metrics):
+    """ Concatenate the single-slice niftis of a single subject, see link_dicoms_with_different_UIDs. 
+    """
+    # dataframe for dicoms with the same SubjectID
+    output_folder = os.path.join(nifti_dir_concat, os.path.basename(SubjectID))
+
+    for FileID in subject_df.FileID.unique():
+
+        # dicoms with the same FileID and SubjectID
+        file_df = subject_df[subject_df.FileID==FileID].sort_values(by=['AcqTime'])
+
+        for Shape in file_df.Shape.unique():
+
+            # dicoms with the same Shape, FileID, and SubjectID
+            shape_df = file_df[file_df.Shape==Shape]
+
+            if len(shape_df) == len(shape_df.SliceLocation.unique()):
+                # all FileIDs have the same shape with slices at different location, 
+                # therefore assume all belong to same acquisition
+                _save_concatenated(shape_df, output_folder, compresslevel, gzip_threads, streaming, metrics)
+            else:
+                # at this point we assume this are likely from the same acquisition. 
+                # We will loop through them in order of acquisition time; if a slice 
+                # is repeated then assume is a different acquisition. 
+
+                slice_locations = []
+                acquisitions    = []
+                for index, slice_location in zip(shape_df.index, shape_df.SliceLocation):
+
+                    if slice_location not in slice_locations:
+                        slice_locations += [slice_location]
+                        acquisitions    += [shape_df[shape_df.index==index]]
+                    else:
+
+                        _save_concatenated(pd.concat(acquisitions), output_folder, compresslevel, gzip_threads, streaming, metrics)
+
+                        slice_locations = []
+                        acquisitions    = []
@@ -0,0 +1,182 @@
+# Manuel A. Morales, PhD (mmorale5@bidmc.harvard.edu)
+# CMR Enthusiast
+
+import os
+import sys
+import json
+import time
+import socket
+import datetime
+import threading
+
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: # not available on Windows, peak memory is then reported as None.
+    resource = None
+
+# counters reported for every run, see RunMetrics.count.
+COUNTERS = ['files_listed', 'files_parsed', 'files_cached', 'bytes_read', 'frames_decoded', 'bytes_written',
+            'series_converted', 'series_skipped', 'niftis_linked']
+
+class RunMetrics:
+    """ Stage-level metrics of a conversion run (header scan, nifti conversion and linking).
+
+        Pass the same instance as `metrics` to folder.export_dicom_headers, convert._export_niftis,
+        link_UIDs.export_linked_niftis and link_UIDs.link_dicoms_with_different_UIDs, then call `finish()` to
+        write the JSON report of the run. The report contains:
+
+        stages     : one record per stage (e.g., `scan` of a subject, `convert` of a series) with its labels, wall
+                     and CPU time (in seconds, CPU time includes the reaped child processes), counters and the peak
+                     resident memory of the run at the end of the stage (in bytes).
+        totals     : wall time, CPU time and number of records of each stage name.
+        counters   : run totals of COUNTERS (files parsed, bytes read, frames decoded, bytes written, ...).
+        rejections : number of dicoms or series rejected by reason (InlineVF, Secondary, unreadable,
+                     variable_phases, failed).
+        peak_memory: peak resident memory of this process and of its largest child process, in bytes.
+
+    Input
+    -----
+    report_path : path of the JSON report written by finish(). If None, the report is only returned.
+
+    hooks       : list of callables `hook(event, record)` used to forward the metrics to an external collector.
+                  They are called with event='stage' and the stage record when a stage ends, and with
+                  event='report' and the full report in finish(). Exceptions raised by hooks are not caught.
+    """
+    enabled = True
+
+    def __init__(self, report_path=None, hooks=()):
+        self.report_path = report_path
+        self.hooks       = list(hooks)
+        self.stages      = []
+        self.counters    = dict.fromkeys(COUNTERS, 0)
+        self.rejections  = {}
+
+        self._open    = []
+        self._lock    = threading.Lock()
+        self._started = datetime.datetime.now().isoformat(timespec='seconds')
+        self._wall    = time.perf_counter()
+        self._cpu     = _cpu_time()
+
+    @contextmanager
+    def stage(self, name, **labels):
+        """ Time the stage `name` (e.g., metrics.stage('scan', subject='subject_dir_1')). Counters added with
+            count() while the stage is open are also added to the stage record, which is yielded.
+        """
+        record = {'stage': name}
+        record.update(labels)
+        wall, cpu = time.perf_counter(), _cpu_time()
+        with self._lock:
+            self._open.append(record)
+        try:
+            yield record
+        finally:
+            with self._lock:
+                self._open.remove(record)
+            self.record(name, time.perf_counter()-wall, _cpu_time()-cpu, record)
+
+    def record(self, name, wall_time, cpu_time, fields=None):
+        """ Add the record of a stage timed elsewhere (e.g., a series converted in a worker process).
+        """
+        record = {'stage': name}
+        record.update(fields or {})
+        record['wall_time']   = wall_time
+        record['cpu_time']    = cpu_time
+        record['peak_memory'] = peak_memory()['self']
+        with self._lock:
+            self.stages.append(record)
+        for hook in self.hooks: hook('stage', record)
+        return record
+
+    def count(self, key, n=1):
+        """ Add `n` to the run counter `key` and to the counters of the open stages.
+        """
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+            for record in self._open:
+                record[key] = record.get(key, 0) + n
+
+    def reject(self, reason, n=1):
+        """ Count `n` dicoms or series rejected for `reason` in the run and in the open stages.
+        """
+        with self._lock:
+            self.rejections[reason] = self.rejections.get(reason, 0) + n
+            for record in self._open:
+                record.setdefault('rejections', {})
+                record['rejections'][reason] = record['rejections'].get(reason, 0) + n
+
+    def report(self):
+        """ Returns the report of the run as a dictionary (see RunMetrics).
+        """
+        totals = {}
+        for record in self.stages:
+            total = totals.setdefault(record['stage'], {'wall_time': 0., 'cpu_time': 0., 'records': 0})
+            total['wall_time'] += record['wall_time']
+            total['cpu_time']  += record['cpu_time']
+            total['records']   += 1
+
+        return {'started':     self._started,
+                'host':        socket.gethostname(),
+                'pid':         os.getpid(),
+                'wall_time':   time.perf_counter() - self._wall,
+                'cpu_time':    _cpu_time() - self._cpu,
+                'peak_memory': peak_memory(),
+                'counters':    dict(self.counters),
+                'rejections':  dict(self.rejections),
+                'totals':      totals,
+                'stages':      list(self.stages)}
+
+    def finish(self):
+        """ Write the report to `report_path` (if given), call the hooks with event='report' and return it.
+        """
+        report = self.report()
+        if self.report_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.report_path)), exist_ok=True)
+            with open(self.report_path + '.tmp', 'w') as f:
+                json.dump(report, f, indent=1, default=_to_json)
+            os.replace(self.report_path + '.tmp', self.report_path)
+        for hook in self.hooks: hook('report', report)
+        return report
+
+class _NoMetrics(RunMetrics):
+    """ Metrics used when none are requested: stages are not timed and nothing is recorded.
+    """
+    enabled = False
+
+    @contextmanager
+    def stage(self, name, **labels):
+        yield {}
+
+    def record(self, name, wall_time, cpu_time, fields=None): pass
+
+    def count(self, key, n=1): pass
+
+    def reject(self, reason, n=1): pass
+
+def get_metrics(metrics):
+    """ Returns `metrics`, or a RunMetrics that records nothing if `metrics` is None.
+    """
+    return _NoMetrics() if metrics is None else metrics
+
+def peak_memory():
+    """ Returns the peak resident memory (in bytes) of this process (`self`) and of its largest reaped child
+        process (`children`), or None where it is not available.
+    """
+    if resource is None: return {'self': None, 'children': None}
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux.
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return {'self':     resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*unit,
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss*unit}
+
+def _cpu_time():
+    """ User and system CPU time of this process and of its reaped child processes, in seconds.
+    """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+def _to_json(value):
+    """ Convert numpy scalars (e.g., counters computed with numpy) for json.dump.
+    """
+    if hasattr(value, 'item'): return value.item()
+    raise TypeError('Object of type %s is not JSON serializable' % type(value).__name__)
@@ -0,0 +1,151 @@
+# Manuel A. Morales, PhD (mmorale5@bidmc.harvard.edu)
+# CMR Enthusiast
+
+import os
+import copy
+import pydicom
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from pydicom.datadict import dictionary_VR
+
+from . import folder
+
+# keys that change between the dicoms of a cine series and are copied from each source dicom.
+FRAME_KEYS = ['ImagePositionPatient', 'SliceLocation', 'InstanceNumber', 'TriggerTime', 'AcquisitionTime']
+
+def export_dicoms(nifti_path, dicom_paths, savedir, SeriesDescription='nifti2dicom', dicoms_headers=None,
+                  workers=None, executor='thread'):
+    """ Convert a 4D nifti (e.g., a segmentation) back to dicom, writing one dicom per (slice, phase).
+
+        The dicoms are built from a header template of the source series, parsed once without pixel data, and from
+        the keys in FRAME_KEYS of each source dicom. These are taken from `dicoms_headers` if given, otherwise only
+        these keys are read from each source dicom. The exported dicoms share a new SeriesInstanceUID and reference
+        the SOPInstanceUID of their source dicom. Voxel values are rounded and stored as unsigned (or signed, if
+        negative) 16-bit integers.
+
+    Input
+    -----
+    nifti_path     : path of a nifti of shape (nx, ny, number_of_slices, number_of_phases) aligned with the cine
+                     converted by convert._export_niftis.
+
+    dicom_paths    : the `nifti2dicom_paths` .npy file of the cine, or its dictionary (see read_cine_protocol).
+
+    savedir        : folder where the dicoms are exported.
+
+    SeriesDescription : description of the exported series.
+
+    dicoms_headers : optional DataFrame of dicom headers (see folder.read_dicom_headers) containing the sources.
+
+    workers        : int, number of workers writing dicoms in parallel (see folder.worker_pool). None writes serially.
+
+    Returns
+    -------
+    exported : list of the paths of the exported dicoms, in (slice, phase) order.
+    """
+    if isinstance(dicom_paths, str): dicom_paths = np.load(dicom_paths, allow_pickle=True).item()
+    paths = np.array([dicom_paths[SliceIndex] for SliceIndex in sorted(dicom_paths)])
+
+    data = np.asanyarray(nib.load(nifti_path).dataobj)
+    data = data.reshape(data.shape[:2] + paths.shape)
+    data, signed = _integer_data(data)
+
+    template = pydicom.read_file(paths[0,0], stop_before_pixels=True)
+    template = _derived_template(template, SeriesDescription, signed)
+    frame_headers = _frame_headers(paths, dicoms_headers)
+
+    os.makedirs(savedir, exist_ok=True)
+    prefix = os.path.basename(nifti_path).split('.nii')[0]
+    frames = [(template, data[:,:,SliceIndex,InstanceIndex], frame_headers[SliceIndex, InstanceIndex],
+               os.path.join(savedir, '%s_slice_%03d_phase_%03d.dcm' % (prefix, SliceIndex, InstanceIndex)))
+              for SliceIndex, InstanceIndex in np.ndindex(paths.shape)]
+
+    with folder.worker_pool(workers, executor) as pool:
+        exported = list(map(_write_frame, *zip(*frames)) if pool is None else pool.map(_write_frame, *zip(*frames)))
+
+    return exported
+
+def _integer_data(data):
+    """ Round the voxel values to 16-bit integers. Returns the data and whether it is signed.
+    """
+    # rounded in float64: np.rint of small dtypes (e.g., float16 for uint8 label maps) overflows when clipped.
+    data = np.rint(np.asarray(data, dtype=float))
+    if data.min() < 0:
+        return np.clip(data, -2**15, 2**15-1).astype(np.int16), True
+    return np.clip(data, 0, 2**16-1).astype(np.uint16), False
+
+def _derived_template(template, SeriesDescription, signed):
+    """ Header template of the exported series: a new series with 16-bit monochrome pixel data.
+    """
+    template = copy.deepcopy(template)
+    template.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    template.is_little_endian = True
+    template.is_implicit_VR   = False
+
+    template.SeriesInstanceUID = generate_uid()
+    template.SeriesDescription = SeriesDescription
+    template.ImageType         = ['DERIVED', 'PRIMARY']
+
+    template.SamplesPerPixel           = 1
+    template.PhotometricInterpretation = 'MONOCHROME2'
+    template.BitsAllocated             = 16
+    template.BitsStored                = 16
+    template.HighBit                   = 15
+    template.PixelRepresentation       = int(signed)
+    for key in ['RescaleSlope', 'RescaleIntercept', 'WindowCenter', 'WindowWidth', 'SmallestImagePixelValue',
+                'LargestImagePixelValue']:
+        if key in template: delattr(template, key)
+    return template
+
+def _frame_headers(paths, dicoms_headers=None):
+    """ Returns an array of the same shape as `paths` with a dictionary of the FRAME_KEYS and SOPInstanceUID of
+        each source dicom, taken from `dicoms_headers` or read from the dicoms without pixel data.
+    """
+    keys = FRAME_KEYS + ['SOPInstanceUID']
+    frame_headers = np.empty(paths.shape, dtype=object)
+    if dicoms_headers is not None:
+        rows = dicoms_headers.set_index('FileName')[keys].loc[paths.ravel()]
+        for index, (_, row) in zip(np.ndindex(paths.shape), rows.iterrows()):
+            frame_headers[index] = {key: row[key] for key in keys}
+    else:
+        for index in np.ndindex(paths.shape):
+            dicom = pydicom.read_file(paths[index], stop_before_pixels=True, specific_tags=keys)
+            frame_headers[index] = {key: dicom[key].value if key in dicom else None for key in keys}
+    return frame_headers
+
+def _header_value(key, value):
+    """ Cast a header `value` (as read by pydicom or from a header DataFrame) to the type of the `key` VR.
+    """
+    VR = dictionary_VR(key)
+    if key == 'ImagePositionPatient' and isinstance(value, str):
+        value = [float(x) for x in value.strip("'[].").split(',')]
+    if VR == 'TM' and not isinstance(value, str): return '%013.6f' % float(value)
+    if VR == 'IS': return int(value)
+    if VR == 'DS': return [float(x) for x in value] if np.ndim(value) else float(value)
+    return value
+
+def _write_frame(template, frame, frame_header, filename):
+    """ Write a single `frame` as a dicom built from the series `template` and the keys of its source dicom.
+    """
+    dicom = copy.deepcopy(template)
+    dicom.SOPInstanceUID = generate_uid()
+    dicom.file_meta.MediaStorageSOPInstanceUID = dicom.SOPInstanceUID
+
+    for key, value in frame_header.items():
+        # missing values are None (pydicom), NaN (csv headers) or pd.NA (parquet headers). 
+        if key == 'SOPInstanceUID' or (np.ndim(value) == 0 and pd.isna(value)): continue
+        setattr(dicom, key, _header_value(key, value))
+
+    if isinstance(frame_header['SOPInstanceUID'], str) and frame_header['SOPInstanceUID']:
+        reference = pydicom.Dataset()
+        reference.ReferencedSOPClassUID    = dicom.SOPClassUID
+        reference.ReferencedSOPInstanceUID = frame_header['SOPInstanceUID']
+        dicom.SourceImageSequence = [reference]
+
+    dicom.Rows, dicom.Columns = frame.shape
+    dicom.PixelData = np.ascontiguousarray(frame).astype(frame.dtype.newbyteorder('<')).tobytes()
+    dicom['PixelData'].VR = 'OW'
+    dicom.save_as(filename, write_like_original=False)
+    return filename
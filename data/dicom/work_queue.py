@@ -0,0 +1,180 @@
+# Manuel A. Morales, PhD (mmorale5@bidmc.harvard.edu)
+# CMR Enthusiast
+
+import os
+import time
+import socket
+import threading
+
+from urllib.parse import quote
+from contextlib import contextmanager
+
+class WorkQueue:
+    """ Lock-file work queue shared by several processes or hosts through a common folder `queue_dir`.
+
+        Each worker iterates over the same list of items (e.g., subject folders) with `claimed(items)` and only gets
+        the items it claimed. Each item has a folder `queue_dir/<item>` holding its lock files `lock.<generation>`
+        and, once processed, a `done` marker, so that no item is processed twice. An item is claimed by atomically
+        creating the lock of the next generation, which is only allowed when the lock of the current (highest)
+        generation is stale. Lock files are never renamed or removed, so that a generation can only be created
+        once: a lock that is not stale can never be taken over, and only one of the workers reclaiming a stale lock
+        creates the next generation (even if it lists the generations long before creating its own).
+
+        While an item is being processed, its lock file is touched every `stale_timeout/4` seconds; locks that were
+        not touched for `stale_timeout` seconds (e.g., the worker was killed) are reclaimed by the other workers.
+        Items whose processing raises an exception are released (their lock is made stale), so that they can be
+        claimed again.
+
+        The done markers persist, so use a new `queue_dir` for each run (e.g., one per run date). The clocks of the
+        hosts sharing the queue should agree to within a fraction of `stale_timeout`.
+
+        Example (run on each host or process):
+
+            work_queue = WorkQueue('/shared/queue/2020_01_02_headers')
+            folder.export_dicom_headers(dicom_dir, headers_dir, work_queue=work_queue)
+
+    Input
+    -----
+    queue_dir     : folder of the lock files, created if needed.
+
+    stale_timeout : seconds after which the lock of an item that is not touched anymore is reclaimed.
+
+    worker_id     : name written in the lock files. Defaults to <hostname>_<pid>.
+    """
+    def __init__(self, queue_dir, stale_timeout=600, worker_id=None):
+        self.queue_dir     = queue_dir
+        self.stale_timeout = stale_timeout
+        self.worker_id     = worker_id or '%s_%d' % (socket.gethostname(), os.getpid())
+        self._held         = {}
+        os.makedirs(queue_dir, exist_ok=True)
+
+    def claimed(self, items, poll=1.0):
+        """ Iterate over the `items` claimed by this worker. Each item is marked as done when the loop continues to
+            the next item, and released if an exception is raised while it is processed. Items claimed by other
+            workers are checked again every `poll` seconds (at most stale_timeout/4) until they are done, so that the
+            items of a worker that died are reclaimed once its locks are stale.
+        """
+        pending = list(items)
+        while pending:
+            for item in pending:
+                if not self.claim(item): continue
+                with self._heartbeat(self._held[self._item_dir(item)]):
+                    try:
+                        yield item
+                    except BaseException:
+                        self.release(item)
+                        raise
+                self.done(item)
+            pending = [item for item in pending if not self.is_done(item)]
+            if pending: time.sleep(min(poll, self.stale_timeout/4))
+
+    def claim(self, item):
+        """ Try to claim `item`. Returns True if it was claimed by this worker, False if it is done or claimed by
+            another worker whose lock is not stale.
+        """
+        if self.is_done(item): return False
+        if not self._acquire(self._item_dir(item)): return False
+        # the item could have been completed between the first check and the creation of the lock.
+        if self.is_done(item):
+            self.release(item)
+            return False
+        return True
+
+    def done(self, item):
+        """ Mark `item` as done and release its lock.
+        """
+        with open(os.path.join(self._item_dir(item), 'done'), 'w') as f:
+            f.write(self.worker_id)
+        self.release(item)
+
+    def release(self, item):
+        """ Release the lock of `item` held by this worker, so that it can be claimed again.
+        """
+        self._release(self._item_dir(item))
+
+    def is_done(self, item):
+        return os.path.isfile(os.path.join(self._item_dir(item), 'done'))
+
+    @contextmanager
+    def locked(self, name, poll=0.05):
+        """ Hold the lock `name` (e.g., to update a file shared by the workers) for the duration of the block.
+            Waits until the lock is free; stale locks are reclaimed as for the items of the queue.
+        """
+        lock_dir = os.path.join(self.queue_dir, '.locks', quote(str(name), safe=''))
+        while not self._acquire(lock_dir):
+            time.sleep(poll)
+        try:
+            with self._heartbeat(self._held[lock_dir]):
+                yield
+        finally:
+            self._release(lock_dir)
+
+    def _item_dir(self, item):
+        return os.path.join(self.queue_dir, quote(str(item), safe=''))
+
+    def _acquire(self, lock_dir):
+        """ Create the lock of the next generation in `lock_dir` if the current lock is missing or stale. Returns
+            True if this worker created it, i.e. holds the lock.
+        """
+        os.makedirs(lock_dir, exist_ok=True)
+        generations = _lock_generations(lock_dir)
+        generation  = 0
+        reclaimed   = False
+        if generations:
+            mtime = os.stat(os.path.join(lock_dir, 'lock.%d' % generations[-1])).st_mtime
+            if time.time() - mtime < self.stale_timeout: return False
+            reclaimed  = mtime > 0 # released locks have a zero modification time.
+            generation = generations[-1] + 1
+
+        lock = os.path.join(lock_dir, 'lock.%d' % generation)
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False # another worker created this generation first.
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.worker_id)
+        self._held[lock_dir] = lock
+
+        # older generations are kept: removing them would let a worker that listed them before this lock was
+        # created (and is about to create the same generation) succeed after this lock is released and superseded.
+        if reclaimed: print('Reclaimed stale lock:', os.path.join(lock_dir, 'lock.%d' % generations[-1]))
+        return True
+
+    def _release(self, lock_dir):
+        """ Make the lock held in `lock_dir` stale, so that the next worker claims the next generation.
+        """
+        lock = self._held.pop(lock_dir, None)
+        if lock is None: return
+        try:
+            os.utime(lock, (0, 0))
+        except FileNotFoundError:
+            pass
+
+    @contextmanager
+    def _heartbeat(self, lock):
+        """ Touch the file `lock` every stale_timeout/4 seconds in a background thread.
+        """
+        stop = threading.Event()
+        def _touch():
+            while not stop.wait(self.stale_timeout/4):
+                try:
+                    os.utime(lock)
+                except FileNotFoundError:
+                    pass
+        thread = threading.Thread(target=_touch, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+def _lock_generations(lock_dir):
+    """ Returns the sorted generations of the lock files in `lock_dir`.
+    """
+    return sorted(int(name[5:]) for name in os.listdir(lock_dir) if name.startswith('lock.') and name[5:].isdigit())
+
+def get_work_queue(work_queue):
+    """ Returns `work_queue` as a WorkQueue, given either a WorkQueue or the path of its folder.
+    """
+    return WorkQueue(work_queue) if isinstance(work_queue, str) else work_queue
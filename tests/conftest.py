@@ -0,0 +1,16 @@
+import pandas as pd
+import pytest
+
+@pytest.fixture
+def cine_headers():
+    """ Factory of header DataFrames of a single cine series with `n_slices` slices of `n_phases` phases each, with
+        the hierarchy keys (see hierarchy.LEVELS) and the geometry of axial slices 1 mm apart.
+    """
+    def _cine_headers(n_slices=2, n_phases=3):
+        rows = [{'FileName': 'dicom_%d_%d.dcm' % (s, p), 'PatientName': 'PATIENT', 'StudyInstanceUID': '1.2',
+                 'SeriesInstanceUID': '1.2.3', 'SliceLocation': float(s), 'InstanceNumber': p + 1,
+                 'SliceThickness': 8.0, 'PixelSpacing': '[1.5, 1.5]', 'ImageOrientationPatient': '[1, 0, 0, 0, 1, 0]',
+                 'ImagePositionPatient': '[0, 0, %d]' % s}
+                for s in range(n_slices) for p in range(n_phases)]
+        return pd.DataFrame(rows)
+    return _cine_headers
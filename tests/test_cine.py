@@ -0,0 +1,9 @@
+import pytest
+
+from data.dicom.cine import LazyCine
+from data.dicom.hierarchy import HeaderIndex
+
+def test_from_index_rejects_unknown_series(cine_headers):
+    headers = cine_headers()
+    with pytest.raises(ValueError, match='9.9.9'):
+        LazyCine.from_index(headers, HeaderIndex.from_headers(headers), '9.9.9')
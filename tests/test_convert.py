@@ -0,0 +1,31 @@
+import numpy as np
+
+from data.dicom import convert
+
+def test_series_geometry_with_missing_values(cine_headers):
+    headers = cine_headers(n_slices=3, n_phases=2)
+    headers.loc[3, 'ImagePositionPatient']    = np.nan
+    headers.loc[5, 'ImageOrientationPatient'] = None
+
+    affines, normals, positions = convert.series_geometry(headers)
+    assert np.isnan(affines[3]).any() and np.isnan(positions[3])
+    assert np.isnan(normals[5]).all() and np.isnan(positions[5])
+
+    complete = np.setdiff1d(np.arange(len(headers)), [3, 5])
+    np.testing.assert_allclose(positions[complete], headers.SliceLocation[complete])
+    np.testing.assert_allclose(affines[0], convert.read_affine(headers.iloc[0]))
+
+def test_cine_index_rejects_missing_positions_only_when_ordering_by_position(cine_headers):
+    headers = cine_headers(n_slices=3, n_phases=2)
+    headers.loc[3, 'ImagePositionPatient'] = np.nan
+
+    _, dicom_4D_grid = convert.cine_index(headers, slice_order='SliceLocation')
+    assert dicom_4D_grid.shape == (3, 2)
+
+    _, dicom_4D_grid = convert.cine_index(headers, slice_order='position')
+    assert dicom_4D_grid is None
+
+def test_strip_nifti_ext_keeps_folders_containing_nii():
+    assert convert._strip_nifti_ext('/data/x.nii_out/P.nii/niftis/P_tf2d_AcqTime_1.nii.gz') == \
+        '/data/x.nii_out/P.nii/niftis/P_tf2d_AcqTime_1'
+    assert convert._strip_nifti_ext('/data/P.nii/niftis/P_tf2d_AcqTime_1.nii') == '/data/P.nii/niftis/P_tf2d_AcqTime_1'
@@ -0,0 +1,35 @@
+import os
+import shutil
+
+import pytest
+
+from benchmarks.synthetic_dicoms import write_archive
+from data.dicom import folder
+
+@pytest.mark.parametrize('queue', [False, True])
+def test_incremental_index_drops_deleted_subjects(tmp_path, queue):
+    dicom_dir, savedir = str(tmp_path / 'dicoms'), str(tmp_path / 'headers')
+    write_archive(dicom_dir, subjects=2, series=1, slices=2, phases=2, matrix=8, single_slice_series=0)
+    work_queue = str(tmp_path / 'queue') if queue else None
+
+    folder.export_dicom_headers(dicom_dir, savedir, incremental=True, work_queue=work_queue)
+    index = folder.load_header_index(savedir + '_index.pkl')
+    assert any(filename.startswith(os.path.join(dicom_dir, 'subject_001', '')) for filename in index)
+
+    shutil.rmtree(os.path.join(dicom_dir, 'subject_001'))
+    folder.export_dicom_headers(dicom_dir, savedir, incremental=True, work_queue=work_queue)
+    index = folder.load_header_index(savedir + '_index.pkl')
+    assert index and all(filename.startswith(os.path.join(dicom_dir, 'subject_000', '')) for filename in index)
+
+def test_make_dataset_is_indexed_in_filename_order(tmp_path):
+    dicom_dir = str(tmp_path / 'dicoms')
+    write_archive(dicom_dir, subjects=1, series=1, slices=2, phases=3, matrix=8, single_slice_series=1)
+    subject_dir = os.path.join(dicom_dir, 'subject_000')
+
+    headers = folder.make_dataset(subject_dir)
+    assert list(headers.index) == list(range(len(headers)))
+    assert list(headers.FileName) == sorted(headers.FileName)
+
+    headers = folder.make_dataset(subject_dir, max_dataset_size=4)
+    assert list(headers.index) == list(range(4))
+    assert list(headers.FileName) == sorted(headers.FileName)
@@ -0,0 +1,36 @@
+import numpy as np
+
+from data.dicom import folder
+from data.dicom.hierarchy import HeaderIndex
+
+def _export(headers, save_prefix):
+    """ Write the header file and its index as _export_subject_patients does. """
+    folder.write_dicom_headers(headers, save_prefix)
+    headers_path  = save_prefix + folder.HEADER_FORMATS['csv']
+    headers_index = HeaderIndex.from_headers(folder.read_dicom_headers(headers_path))
+    with open(headers_path, 'rb') as f:
+        headers_index.digest = folder.header_file_digest(f.read())
+    headers_index.save(save_prefix + folder.HIERARCHY_SUFFIX)
+    return headers_path
+
+def test_saved_hierarchy_is_reused_for_same_header_file(tmp_path, cine_headers):
+    headers_path = _export(cine_headers(), str(tmp_path / 'PATIENT'))
+    dicoms_headers = folder.read_dicom_headers(headers_path)
+
+    headers_index = folder.read_header_hierarchy(headers_path, dicoms_headers)
+    assert headers_index.digest is not None
+    assert headers_index.series_grid(headers_index.series('1.2.3')).shape == (2, 3)
+
+def test_saved_hierarchy_is_rebuilt_for_changed_rows(tmp_path, cine_headers):
+    headers_path = _export(cine_headers(), str(tmp_path / 'PATIENT'))
+
+    # same files, but one cine frame moved to another slice location (e.g., a re-exported dicom).
+    headers = cine_headers()
+    headers.loc[0, 'SliceLocation'] = 1.0
+    folder.write_dicom_headers(headers, str(tmp_path / 'PATIENT'))
+    dicoms_headers = folder.read_dicom_headers(headers_path)
+
+    headers_index = folder.read_header_hierarchy(headers_path, dicoms_headers)
+    assert headers_index.digest is None
+    assert headers_index.series_grid(headers_index.series('1.2.3')) is None
+    np.testing.assert_array_equal(np.sort(headers_index.group_rows('PatientName', 0)), np.arange(len(headers)))
@@ -0,0 +1,40 @@
+import numpy as np
+import nibabel as nib
+import pandas as pd
+
+from data.dicom import link_UIDs
+
+def _scaled_slices(folder, n_slices=5, shape=(4, 3, 1, 2), slope=0.5, inter=3.0):
+    rng = np.random.default_rng(0)
+    paths = []
+    for slice_index in range(n_slices):
+        nifti = nib.Nifti1Image(rng.integers(-100, 100, size=shape).astype(np.int16), affine=np.eye(4))
+        nifti.header.set_slope_inter(slope, inter)
+        path = str(folder / ('slice_%d.nii' % slice_index))
+        nib.save(nifti, path)
+        paths += [path]
+    return pd.DataFrame({'NiftiPath': paths})
+
+def test_concatenate_scaled_slices_in_memory_and_streamed(tmp_path):
+    file_df = _scaled_slices(tmp_path)
+    expected = np.concatenate([nib.load(path).get_fdata() for path in file_df.NiftiPath], axis=2)
+    assert not np.array_equal(expected, np.concatenate([nib.load(path).dataobj.get_unscaled()
+                                                        for path in file_df.NiftiPath], axis=2))
+
+    in_memory = link_UIDs.concatenate_dicoms(file_df)
+    streamed  = link_UIDs.concatenate_dicoms(file_df, out_file=str(tmp_path / 'stream.nii'))
+
+    np.testing.assert_allclose(in_memory.get_fdata(), expected)
+    np.testing.assert_allclose(streamed.get_fdata(), expected)
+
+def test_linked_job_paths_share_the_nifti_file_id():
+    job = {'save_nii':     '/out/P/niftis/P_tf2d_AcqTime_120.nii.gz',
+           'save_npy':     '/out/P/slice_locations/P_tf2d_slice_locations_AcqTime_120.npy',
+           'save_npy_dic': '/out/P/nifti2dicom_paths/P_tf2d_dicom_paths_AcqTime_120.npy',
+           'header':       pd.DataFrame({'Rows': [4], 'Columns': [3], 'PixelSpacing': ['[1, 1]']})}
+    linked_job = link_UIDs._linked_job([(job, 0.0), (job, 1.0)])
+
+    FileID, AcqTime = linked_job['save_nii'].split('/')[-1][:-len('.nii.gz')].split('_AcqTime_')
+    assert FileID == 'P_tf2d_linked'
+    assert linked_job['save_npy'].endswith(FileID + '_slice_locations_AcqTime_%s.npy' % AcqTime)
+    assert linked_job['save_npy_dic'].endswith(FileID + '_dicom_paths_AcqTime_%s.npy' % AcqTime)
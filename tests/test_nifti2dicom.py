@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+import pydicom
+import nibabel as nib
+
+from benchmarks.synthetic_dicoms import write_archive
+from data.dicom import convert, folder, nifti2dicom
+
+def test_export_dicoms_with_missing_header_values(tmp_path):
+    dicom_dir = str(tmp_path / 'dicoms')
+    write_archive(dicom_dir, subjects=1, series=1, slices=2, phases=3, matrix=8, single_slice_series=0)
+    dicoms_headers = folder.make_dataset(dicom_dir)
+    _, dicom_4D_grid = convert.cine_index(dicoms_headers)
+    dicom_paths = {SliceIndex: list(dicom_4D_grid[SliceIndex]) for SliceIndex in range(len(dicom_4D_grid))}
+
+    # missing SOPInstanceUID read back from a csv header (NaN) and InstanceNumber from a parquet header (pd.NA).
+    missing = dicom_4D_grid[0, 0]
+    dicoms_headers['SOPInstanceUID'] = dicoms_headers.SOPInstanceUID.astype(object)
+    dicoms_headers.loc[dicoms_headers.FileName == missing, 'SOPInstanceUID'] = np.nan
+    dicoms_headers['InstanceNumber'] = dicoms_headers.InstanceNumber.astype('Int64')
+    dicoms_headers.loc[dicoms_headers.FileName == missing, 'InstanceNumber'] = pd.NA
+
+    nifti_path = str(tmp_path / 'segmentation.nii.gz')
+    nib.save(nib.Nifti1Image(np.ones((8, 8, 2, 3), dtype=np.uint8), np.eye(4)), nifti_path)
+    exported = nifti2dicom.export_dicoms(nifti_path, dicom_paths, str(tmp_path / 'out'), dicoms_headers=dicoms_headers)
+
+    assert len(exported) == 6
+    first, second = pydicom.dcmread(exported[0]), pydicom.dcmread(exported[1])
+    assert 'SourceImageSequence' not in first
+    assert second.SourceImageSequence[0].ReferencedSOPInstanceUID == \
+        dicoms_headers.set_index('FileName').SOPInstanceUID[dicom_4D_grid[0, 1]]
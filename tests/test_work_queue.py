@@ -0,0 +1,64 @@
+import os
+
+from data.dicom import work_queue as wq
+from data.dicom.work_queue import WorkQueue
+
+def _delayed_open(monkeypatch, before_open):
+    """ Patch os.open in work_queue so that `before_open()` runs once, between the listing of the lock generations
+        and the creation of the next one by the first worker that opens a lock.
+    """
+    real_open = os.open
+    calls     = []
+    def _open(path, *args, **kwargs):
+        if not calls:
+            calls.append(path)
+            before_open()
+        return real_open(path, *args, **kwargs)
+    monkeypatch.setattr(wq.os, 'open', _open)
+
+def _lock_owners(lock_dir):
+    owners = {}
+    for name in sorted(os.listdir(lock_dir)):
+        if name.startswith('lock.'):
+            with open(os.path.join(lock_dir, name)) as f:
+                owners[name] = f.read()
+    return owners
+
+def test_delayed_reclaim_does_not_share_item(tmp_path, monkeypatch):
+    queue_dir = str(tmp_path / 'queue')
+    X, Y, Z, W = [WorkQueue(queue_dir, worker_id=name) for name in 'XYZW']
+    assert X.claim('subject')
+    X.release('subject')
+
+    # Z finds lock.0 stale, then Y claims and releases the item and W claims it before Z creates its lock.
+    def _interleave():
+        monkeypatch.undo()
+        assert Y.claim('subject')
+        Y.release('subject')
+        assert W.claim('subject')
+    _delayed_open(monkeypatch, _interleave)
+
+    assert not Z.claim('subject')
+    assert list(_lock_owners(os.path.join(queue_dir, 'subject')).values())[-1] == 'W'
+
+def test_delayed_reclaim_does_not_share_named_lock(tmp_path, monkeypatch):
+    queue_dir = str(tmp_path / 'queue')
+    X, Y, Z, W = [WorkQueue(queue_dir, worker_id=name) for name in 'XYZW']
+    lock_dir  = os.path.join(queue_dir, '.locks', 'manifest')
+    with X.locked('manifest'): pass
+
+    def _interleave():
+        monkeypatch.undo()
+        with Y.locked('manifest'): pass
+        assert W._acquire(lock_dir)
+    _delayed_open(monkeypatch, _interleave)
+
+    assert not Z._acquire(lock_dir)
+    W._release(lock_dir)
+    assert Z._acquire(lock_dir)
+
+def test_claimed_items_are_done_once(tmp_path):
+    queue_dir = str(tmp_path / 'queue')
+    first     = list(WorkQueue(queue_dir, worker_id='A').claimed(range(5)))
+    second    = list(WorkQueue(queue_dir, worker_id='B').claimed(range(5)))
+    assert first == list(range(5)) and second == []